@@ -0,0 +1,101 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from beat81 import db_helper
+
+# All database work of the bot runs on one dedicated thread, so a slow disk or a lock held by the
+# scheduler never blocks the event loop. The sync db_helper functions stay usable from the jobs.
+db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db")
+
+
+async def run_in_db_thread(function, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(db_executor, partial(function, *args, **kwargs))
+
+
+def shutdown_db_thread():
+    db_executor.submit(db_helper.close_connection)
+    db_executor.shutdown(wait=True)
+
+
+async def save_user(telegram_user_id, beat81_user_id, email, token, first_name, last_name, token_exp=None):
+    return await run_in_db_thread(db_helper.save_user, telegram_user_id, beat81_user_id, email, token, first_name,
+                                  last_name, token_exp=token_exp)
+
+
+async def save_subscription(telegram_user_id, location_id, city, day_of_week, time):
+    return await run_in_db_thread(db_helper.save_subscription, telegram_user_id, location_id, city, day_of_week, time)
+
+
+async def save_auto_join(telegram_user_id, ticket_id, event_id, event_start=None):
+    return await run_in_db_thread(db_helper.save_auto_join, telegram_user_id, ticket_id, event_id,
+                                  event_start=event_start)
+
+
+async def save_subscriptions(subscriptions):
+    return await run_in_db_thread(db_helper.save_subscriptions, list(subscriptions))
+
+
+async def save_auto_joins(auto_joins):
+    return await run_in_db_thread(db_helper.save_auto_joins, list(auto_joins))
+
+
+async def get_user_by_email(email):
+    return await run_in_db_thread(db_helper.get_user_by_email, email)
+
+
+async def get_user_by_user_id(telegram_user_id):
+    return await run_in_db_thread(db_helper.get_user_by_user_id, telegram_user_id)
+
+
+async def get_all_subscriptions():
+    return await run_in_db_thread(db_helper.get_all_subscriptions)
+
+
+async def get_all_auto_joins():
+    return await run_in_db_thread(db_helper.get_all_auto_joins)
+
+
+async def get_user_subscriptions(telegram_user_id):
+    return await run_in_db_thread(db_helper.get_user_subscriptions, telegram_user_id)
+
+
+async def get_user_auto_joins(telegram_user_id):
+    return await run_in_db_thread(db_helper.get_user_auto_joins, telegram_user_id)
+
+
+async def get_subscription_by_id(subscription_id):
+    return await run_in_db_thread(db_helper.get_subscription_by_id, subscription_id)
+
+
+async def get_auto_join_by_id(auto_join_id):
+    return await run_in_db_thread(db_helper.get_auto_join_by_id, auto_join_id)
+
+
+async def get_auto_join_by_event_id(event_id):
+    return await run_in_db_thread(db_helper.get_auto_join_by_event_id, event_id)
+
+
+async def cancel_subscription(subscription_id):
+    return await run_in_db_thread(db_helper.cancel_subscription, subscription_id)
+
+
+async def cancel_auto_join(auto_join_id):
+    return await run_in_db_thread(db_helper.cancel_auto_join, auto_join_id)
+
+
+async def delete_auto_join_by_ticket_id(ticket_id):
+    return await run_in_db_thread(db_helper.delete_auto_join_by_ticket_id, ticket_id)
+
+
+async def clear_token(telegram_user_id):
+    return await run_in_db_thread(db_helper.clear_token, telegram_user_id)
+
+
+async def get_pending_relogin_notices():
+    return await run_in_db_thread(db_helper.get_pending_relogin_notices)
+
+
+async def mark_relogin_notice_sent(telegram_user_id):
+    return await run_in_db_thread(db_helper.mark_relogin_notice_sent, telegram_user_id)
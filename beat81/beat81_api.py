@@ -1,45 +1,163 @@
-from datetime import datetime, timedelta
+import contextvars
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 
 import jwt
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
+from beat81.cache_helper import TTLCache
 from beat81.city_helper import City
-from beat81.date_helper import next_date_to_day, get_date_from_string, get_date_after, get_weekday_form_date, \
-    get_date_formatted_hour
+from beat81.date_helper import next_date_to_day, get_date_from_string, get_weekday_form_date, \
+    get_date_formatted_hour, get_date_cet
 from beat81.db_helper import init_db, save_user, get_user_by_user_id, save_subscription
+from beat81.location_cache import get_cached_location, cache_location
+from beat81.priority_helper import PriorityGate
+from beat81.rate_limit_helper import RateLimiter, CircuitBreaker, CircuitOpenError
+from beat81.single_flight_helper import SingleFlight
 
 init_db()
 
+API_URL = "https://api.production.b81.io/api"
+REQUEST_TIMEOUT = (float(os.getenv("BEAT81_CONNECT_TIMEOUT", 5)), float(os.getenv("BEAT81_READ_TIMEOUT", 30)))
+POOL_SIZE = int(os.getenv("BEAT81_POOL_SIZE", 20))
+EVENTS_CACHE_TTL = float(os.getenv("EVENTS_CACHE_TTL", 60))
+EVENTS_CACHE_SIZE = int(os.getenv("EVENTS_CACHE_SIZE", 256))
+
+TICKET_CACHE_TTL = float(os.getenv("TICKET_CACHE_TTL", 30))
+RATE_LIMIT = float(os.getenv("BEAT81_RATE_LIMIT", 10))
+MAX_IN_FLIGHT = int(os.getenv("BEAT81_MAX_IN_FLIGHT", 16))
+INTERACTIVE_RESERVED = int(os.getenv("BEAT81_INTERACTIVE_RESERVED", 4))
+
+# Week-day listings are shared by every user, keyed by city, date range and limit
+events_cache = TTLCache(maxsize=EVENTS_CACHE_SIZE, ttl=EVENTS_CACHE_TTL)
+# Shared by the sync and the asyncio client, budgets are (requests per second, burst)
+rate_limiter = RateLimiter(RATE_LIMIT, RATE_LIMIT * 2, {
+    "POST authentication": (0.5, 3),
+    "GET events": (RATE_LIMIT / 2, RATE_LIMIT),
+    "GET locations": (RATE_LIMIT / 5, RATE_LIMIT / 2),
+    "GET tickets": (RATE_LIMIT / 2, RATE_LIMIT),
+    "POST tickets": (RATE_LIMIT / 2, RATE_LIMIT),
+})
+circuit_breaker = CircuitBreaker(failure_threshold=5, reset_timeout=10, max_reset_timeout=300)
+# Outbound slots go to interactive requests first, then auto-joins, then bulk subscription traffic
+priority_gate = PriorityGate(MAX_IN_FLIGHT, INTERACTIVE_RESERVED)
+# Identical concurrent reads share one in-flight request, this also covers a cold cache under a burst
+read_flights = SingleFlight()
+# Upcoming tickets of a user by ticket id, dropped whenever the user books, cancels or registers
+ticket_cache = TTLCache(maxsize=1024, ttl=TICKET_CACHE_TTL)
+# Bumped on every invalidation, a fetch that started before it must not cache its stale result
+ticket_generations = {}
+
 
 class UnauthorizedException(Exception):
     """Custom exception to handle 401 Unauthorized errors."""
     pass
 
 
-# API login function
-def login(telegram_user_id, email, password):
-    url = "https://api.production.b81.io/api/authentication"  # The login API URL
-    payload = {
+class IncompletePagesException(Exception):
+    """Raised when a page of a paged listing could not be fetched."""
+    pass
+
+
+class CircuitOpenException(CircuitOpenError, requests.exceptions.RequestException):
+    """Raised without calling the API while the Beat81 circuit breaker is open."""
+    pass
+
+
+def create_session():
+    # Only idempotent GETs are retried on failed responses, POSTs are retried on connection errors only
+    retry = Retry(total=3, connect=3, read=2, backoff_factor=0.5, status_forcelist=(502, 503, 504),
+                  allowed_methods=frozenset(["GET"]), raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE, max_retries=retry)
+    new_session = requests.Session()
+    new_session.mount("https://", adapter)
+    return new_session
+
+
+# Shared keep-alive client, every Beat81 endpoint goes through it
+session = create_session()
+
+
+def endpoint_name(method, path):
+    return f"{method} {path.strip('/').split('/')[0]}"
+
+
+def record_response(status_code, headers):
+    # 429 and 5xx count against the upstream's health, any other answer proves it is reachable
+    if status_code == 429:
+        try:
+            retry_after = float(headers.get("Retry-After"))
+        except (TypeError, ValueError):
+            retry_after = None
+        circuit_breaker.record_failure(retry_after)
+    elif status_code >= 500:
+        circuit_breaker.record_failure()
+    else:
+        circuit_breaker.record_success()
+
+
+def api_request(method, path, **kwargs):
+    if not circuit_breaker.allow():
+        raise CircuitOpenException(f"Beat81 API circuit breaker is open, skipping {method} {path}")
+    settled = False
+    try:
+        with priority_gate.slot():
+            rate_limiter.acquire(endpoint_name(method, path))
+            try:
+                response = session.request(method, API_URL + path, timeout=REQUEST_TIMEOUT, **kwargs)
+            except requests.exceptions.RequestException:
+                settled = True
+                circuit_breaker.record_failure()
+                raise
+        settled = True
+        record_response(response.status_code, response.headers)
+        return response
+    finally:
+        if not settled:
+            circuit_breaker.release_trial()
+
+
+def api_get(path, **kwargs):
+    return api_request("GET", path, **kwargs)
+
+
+def api_post(path, **kwargs):
+    return api_request("POST", path, **kwargs)
+
+
+def login_payload(email, password):
+    return {
         "email": email.lower(),
         "password": password,
         "strategy": "local"
     }
 
+
+def save_login_token(telegram_user_id, email, token):
+    user_info = extract_data_from_jwt(token)
+
+    if save_user(telegram_user_id=telegram_user_id, beat81_user_id=user_info['userId'], email=email,
+                 token=token, first_name=user_info['given_name'], last_name=user_info['family_name'],
+                 token_exp=user_info['exp']):
+        print(f"{email} saved to the database.")
+    else:
+        print(f"{email} already exists in the database.")
+
+
+# API login function
+def login(telegram_user_id, email, password):
+    payload = login_payload(email, password)
+
     try:
-        response = requests.post(url, json=payload)
+        response = api_post("/authentication", json=payload)
 
         # Check if the API call was successful
         if response.status_code == 201:
             response_data = response.json()
-            token = response_data.get("data", {}).get("accessToken")
-            user_info = extract_data_from_jwt(token)
-
-            if save_user(telegram_user_id=telegram_user_id, beat81_user_id=user_info['userId'], email=email,
-                         token=token, first_name=user_info['given_name'], last_name=user_info['family_name']):
-                print(f"{email} saved to the database.")
-            else:
-                print(f"{email} already exists in the database.")
-
+            save_login_token(telegram_user_id, email, response_data.get("data", {}).get("accessToken"))
             return True
         elif response.status_code == 401:
             return False
@@ -52,22 +170,25 @@ def login(telegram_user_id, email, password):
         return False
 
 
-def tickets(telegram_user_id):
-    user = get_user_by_user_id(telegram_user_id)
-
-    url = "https://api.production.b81.io/api/tickets"
-
+def tickets_params(user, limit=30, skip=0, since=None):
     # Prepare query parameters
     params = {}
     params["user_id"] = user['beat81_user_id']
     params["status_ne"] = 'cancelled'
-    params["event_date_begin_gte"] = datetime.now()
+    params["event_date_begin_gte"] = str(since or datetime.now())
     params["$sort[event_date_begin]"] = '1'
-    params["$limit"] = '30'
+    params["$limit"] = str(limit)
+    params["$skip"] = str(skip)
+    return params
+
+
+def tickets(telegram_user_id, limit=30, skip=0, since=None):
+    user = get_user_by_user_id(telegram_user_id)
+    params = tickets_params(user, limit, skip, since)
 
     try:
         headers = {"Authorization": f"Bearer {user['token']}"}
-        response = requests.get(url, params=params, headers=headers)
+        response = api_get("/tickets", params=params, headers=headers)
 
         # Check if the request was successful
         if response.status_code == 200:
@@ -84,15 +205,21 @@ def tickets(telegram_user_id):
         return None
 
 
+def invalidate_user_tickets(telegram_user_id):
+    cache_key = str(telegram_user_id)
+    ticket_generations[cache_key] = ticket_generations.get(cache_key, 0) + 1
+    ticket_cache.delete(cache_key)
+
+
 def ticket_cancel(telegram_user_id, ticket_id):
     user = get_user_by_user_id(telegram_user_id)
-    url = "https://api.production.b81.io/api/tickets/" + ticket_id + "/status"
     payload = {
         "status_name": "cancelled"
     }
     headers = {"Authorization": f"Bearer {user['token']}"}
     try:
-        response = requests.post(url, json=payload, headers=headers)
+        response = api_post("/tickets/" + ticket_id + "/status", json=payload, headers=headers)
+        invalidate_user_tickets(telegram_user_id)
         if response.status_code == 200:
             return True
         else:
@@ -105,13 +232,13 @@ def ticket_cancel(telegram_user_id, ticket_id):
 
 def ticket_book(telegram_user_id, ticket_id):
     user = get_user_by_user_id(telegram_user_id)
-    url = "https://api.production.b81.io/api/tickets/" + ticket_id + "/status"
     payload = {
         "status_name": "booked"
     }
     headers = {"Authorization": f"Bearer {user['token']}"}
     try:
-        response = requests.post(url, json=payload, headers=headers)
+        response = api_post("/tickets/" + ticket_id + "/status", json=payload, headers=headers)
+        invalidate_user_tickets(telegram_user_id)
         if response.status_code == 200:
             return True
         else:
@@ -123,10 +250,9 @@ def ticket_book(telegram_user_id, ticket_id):
 
 def ticket_info(telegram_user_id, ticket_id):
     user = get_user_by_user_id(telegram_user_id)
-    url = "https://api.production.b81.io/api/tickets/" + ticket_id
     headers = {"Authorization": f"Bearer {user['token']}"}
     try:
-        response = requests.get(url, headers=headers)
+        response = api_get("/tickets/" + ticket_id, headers=headers)
         if response.status_code == 200:
             ticket_data = response.json()
             return ticket_data
@@ -139,10 +265,12 @@ def ticket_info(telegram_user_id, ticket_id):
 
 
 def event_info(event_id):
-    url = "https://api.production.b81.io/api/events/" + event_id
+    return read_flights.do(("event", event_id), fetch_event_info, event_id)
+
 
+def fetch_event_info(event_id):
     try:
-        response = requests.get(url)
+        response = api_get("/events/" + event_id)
         if response.status_code == 200:
             event_data = response.json()
             return event_data
@@ -155,12 +283,18 @@ def event_info(event_id):
 
 
 def location_info(location_id):
-    url = "https://api.production.b81.io/api/locations/" + location_id
+    location_data = get_cached_location(location_id)
+    if location_data is not None:
+        return location_data
+    return read_flights.do(("location", location_id), fetch_location_info, location_id)
 
+
+def fetch_location_info(location_id):
     try:
-        response = requests.get(url)
+        response = api_get("/locations/" + location_id)
         if response.status_code == 200:
             location_data = response.json()
+            cache_location(location_id, location_data)
             return location_data
         else:
             print(f"Failed to fetch location: {response.status_code}: {response.text}")
@@ -172,16 +306,14 @@ def location_info(location_id):
 
 def register_event(event_id, telegram_user_id):
     user = get_user_by_user_id(telegram_user_id)
-    url = "https://api.production.b81.io/api/tickets"
-    payload = {
-        "event_id": event_id,
-        "user_id": user['beat81_user_id']
-    }
+    payload = register_payload(event_id, user)
     headers = {"Authorization": f"Bearer {user['token']}"}
     try:
-        response = requests.post(url, json=payload, headers=headers)
+        response = api_post("/tickets", json=payload, headers=headers)
+        invalidate_user_tickets(telegram_user_id)
         if response.status_code == 200:
             print(f"Registering event {event_id}, user: {telegram_user_id}")
+            invalidate_events_cache(event_id)
             register_data = response.json()
             return register_data
         else:
@@ -192,26 +324,53 @@ def register_event(event_id, telegram_user_id):
         return None
 
 
-def events(city, dayOfWeek=None, start_date=None, end_date=None, limit=200):
-    url = "https://api.production.b81.io/api/events/"
+def events_params(city, dayOfWeek=None, start_date=None, end_date=None, limit=200, skip=0):
     date = next_date_to_day(dayOfWeek)
     date_gte = start_date if start_date else date
     date_lte = end_date if end_date else date + timedelta(days=1)
 
     params = {}
     params["$sort[date_begin]"] = '1'
-    params["date_begin_gte"] = date_gte
-    params["date_begin_lte"] = date_lte
+    params["date_begin_gte"] = str(date_gte)
+    params["date_begin_lte"] = str(date_lte)
     params["$sort[coach_id]"] = '1'
     params["is_published"] = 'true'
     params["status_ne"] = 'cancelled'
     params["location_city_code"] = city.name
     params["$limit"] = limit
+    params["$skip"] = skip
+    return params
+
 
+def events_cache_key(params):
+    return (params["location_city_code"], params["date_begin_gte"], params["date_begin_lte"], params["$limit"],
+            params["$skip"])
+
+
+def invalidate_events_cache(event_id=None):
+    # Drop only the listings that contain the event, its participants count just changed
+    if event_id is None:
+        events_cache.clear()
+        return
+    events_cache.delete_where(
+        lambda key, event_data: any(event.get('id') == event_id for event in event_data.get('data', [])))
+
+
+def events(city, dayOfWeek=None, start_date=None, end_date=None, limit=200, skip=0):
+    params = events_params(city, dayOfWeek, start_date, end_date, limit, skip)
+    cache_key = events_cache_key(params)
+    event_data = events_cache.get(cache_key)
+    if event_data is not None:
+        return event_data
+    return read_flights.do(("events", *cache_key), fetch_events, params, cache_key)
+
+
+def fetch_events(params, cache_key):
     try:
-        response = requests.get(url, params=params)
+        response = api_get("/events/", params=params)
         if response.status_code == 200:
             event_data = response.json()
+            events_cache.set(cache_key, event_data)
             return event_data
         else:
             print(f"Failed to fetch event: {response.status_code}: {response.text}")
@@ -221,8 +380,41 @@ def events(city, dayOfWeek=None, start_date=None, end_date=None, limit=200):
         return None
 
 
-def register_series(event_id, telegram_user_id):
-    event_data = event_info(event_id).get('data')
+def register_payload(event_id, user):
+    return {
+        "event_id": event_id,
+        "user_id": user['beat81_user_id']
+    }
+
+
+def iter_pages(fetch_page):
+    # Yields the records of each page while the next page is already being fetched,
+    # a failed page ends the iteration
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="prefetch")
+    # The prefetch thread runs with the caller's request priority
+    context = contextvars.copy_context()
+    try:
+        next_page = executor.submit(context.run, fetch_page, 0)
+        skip = 0
+        while next_page is not None:
+            page = next_page.result()
+            next_page = None
+            if page is None:
+                return
+            page_data = page.get('data', [])
+            skip += len(page_data)
+            if page_data and skip < page.get('total', 0):
+                next_page = executor.submit(context.run, fetch_page, skip)
+            yield from page_data
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def iter_events(city, start_date, end_date, page_size=200):
+    return iter_pages(lambda skip: events(city, start_date=start_date, end_date=end_date, limit=page_size, skip=skip))
+
+
+def save_series_subscription(event_data, telegram_user_id):
     location_id = event_data.get('location_id')
     iso_date = event_data.get('date_begin')
     day_of_week = get_weekday_form_date(iso_date)
@@ -230,21 +422,33 @@ def register_series(event_id, telegram_user_id):
     city = City[event_data.get('location').get('city_code')]
     save_subscription(telegram_user_id, location_id, city, day_of_week, time)
     date = get_date_from_string(event_data.get('date_begin'))
-    register_recursive(event_id, telegram_user_id, city, location_id, date)
+    return city, location_id, date
 
 
-def register_recursive(event_id, telegram_user_id, city, location_id, date):
-    register_event(event_id, telegram_user_id)
-    next_date = date + timedelta(days=7)
-    if next_date > get_date_after(21):
-        return
-    next_event = find_next_event(city, location_id, next_date)
-    register_recursive(next_event.get('id'), telegram_user_id, city, location_id, next_date)
+def series_events(all_events, first_event):
+    # Same location, weekday and local start time, one event per week
+    location_id = first_event.get('location_id')
+    day_of_week = get_weekday_form_date(first_event.get('date_begin'))
+    time = get_date_formatted_hour(first_event.get('date_begin'))
+    series = {}
+    for event in all_events:
+        iso_date = event.get('date_begin')
+        if (event.get('location_id') == location_id and get_weekday_form_date(iso_date) == day_of_week
+                and get_date_formatted_hour(iso_date) == time):
+            series.setdefault(get_date_cet(iso_date).date(), event)
+    return list(series.values())
+
+
+def day_events(city, day):
+    day_start = datetime(day.year, day.month, day.day, tzinfo=timezone.utc)
+    return list(iter_events(city, day_start, day_start + timedelta(days=1)))
 
 
-def find_next_event(city, location_id, date):
-    all_events = events(city, start_date=date, end_date=date, limit=10).get('data')
-    return [event for event in all_events if event.get('location_id') == location_id][0]
+def find_event_at(all_events, location_id, date):
+    for event in all_events:
+        if event.get('location_id') == location_id and get_date_from_string(event.get('date_begin')) == date:
+            return event
+    return None
 
 
 def extract_data_from_jwt(jwt_token, secret_key=None):
@@ -262,7 +466,8 @@ def extract_data_from_jwt(jwt_token, secret_key=None):
             "userId": decoded_data.get("userId"),
             "given_name": decoded_data.get("given_name"),
             "family_name": decoded_data.get("family_name"),
-            "email": decoded_data.get("email")
+            "email": decoded_data.get("email"),
+            "exp": decoded_data.get("exp")
         }
         return user_data
 
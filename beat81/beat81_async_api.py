@@ -0,0 +1,355 @@
+import asyncio
+from datetime import datetime
+
+import httpx
+
+from beat81.beat81_api import API_URL, REQUEST_TIMEOUT, POOL_SIZE, UnauthorizedException, login_payload, \
+    save_login_token, tickets_params, events_params, register_payload, save_series_subscription, series_events, \
+    events_cache, events_cache_key, invalidate_events_cache, ticket_cache, invalidate_user_tickets, endpoint_name, \
+    record_response, rate_limiter, circuit_breaker, priority_gate, ticket_generations, IncompletePagesException
+from beat81.async_db_helper import get_user_by_user_id, run_in_db_thread
+from beat81.date_helper import get_date_after
+from beat81.location_cache import get_cached_location, get_cached_locations, cache_location
+from beat81.rate_limit_helper import CircuitOpenError
+from beat81.single_flight_helper import AsyncSingleFlight
+
+RETRY_STATUSES = (502, 503, 504)
+GET_RETRIES = 3
+
+client = None
+# Identical concurrent reads of the bot share one in-flight request
+read_flights = AsyncSingleFlight()
+
+
+def get_client():
+    # Created lazily so the client is bound to the bot's running event loop
+    global client
+    if client is None:
+        client = httpx.AsyncClient(
+            base_url=API_URL,
+            timeout=httpx.Timeout(REQUEST_TIMEOUT[1], connect=REQUEST_TIMEOUT[0]),
+            limits=httpx.Limits(max_connections=POOL_SIZE, max_keepalive_connections=POOL_SIZE),
+            transport=httpx.AsyncHTTPTransport(retries=GET_RETRIES))
+    return client
+
+
+async def close_client():
+    global client
+    if client is not None:
+        await client.aclose()
+        client = None
+
+
+class AsyncCircuitOpenException(CircuitOpenError, httpx.HTTPError):
+    """Raised without calling the API while the Beat81 circuit breaker is open."""
+    pass
+
+
+async def api_request(method, path, **kwargs):
+    if not circuit_breaker.allow():
+        raise AsyncCircuitOpenException(f"Beat81 API circuit breaker is open, skipping {method} {path}")
+    settled = False
+    try:
+        async with priority_gate.async_slot():
+            await rate_limiter.acquire_async(endpoint_name(method, path))
+            try:
+                response = await get_client().request(method, path, **kwargs)
+            except httpx.TransportError:
+                settled = True
+                circuit_breaker.record_failure()
+                raise
+        settled = True
+        record_response(response.status_code, response.headers)
+        return response
+    finally:
+        # Cancelled or failed before Beat81 answered, that says nothing about upstream health
+        if not settled:
+            circuit_breaker.release_trial()
+
+
+async def api_get(path, **kwargs):
+    # Idempotent GETs are retried with backoff, the transport itself only retries failed connects
+    for attempt in range(GET_RETRIES + 1):
+        response = await api_request("GET", path, **kwargs)
+        if response.status_code not in RETRY_STATUSES or attempt == GET_RETRIES:
+            return response
+        await asyncio.sleep(0.5 * 2 ** attempt)
+
+
+async def api_post(path, **kwargs):
+    return await api_request("POST", path, **kwargs)
+
+
+async def login(telegram_user_id, email, password):
+    payload = login_payload(email, password)
+
+    try:
+        response = await api_post("/authentication", json=payload)
+
+        if response.status_code == 201:
+            response_data = response.json()
+            await run_in_db_thread(save_login_token, telegram_user_id, email,
+                                   response_data.get("data", {}).get("accessToken"))
+            return True
+        elif response.status_code == 401:
+            return False
+        else:
+            print(f"Unexpected response: {response.status_code}: {response.text}")
+            return False
+
+    except httpx.HTTPError as e:
+        print(f"Error while calling the login API: {e}")
+        return False
+
+
+async def tickets(telegram_user_id, limit=30, skip=0, since=None):
+    user = await get_user_by_user_id(telegram_user_id)
+    params = tickets_params(user, limit, skip, since)
+
+    try:
+        headers = {"Authorization": f"Bearer {user['token']}"}
+        response = await api_get("/tickets", params=params, headers=headers)
+
+        if response.status_code == 200:
+            return response.json()
+        elif response.status_code == 401:
+            raise UnauthorizedException("401 Unauthorized: Invalid credentials or token.")
+        else:
+            print(f"Failed to fetch tickets: {response.status_code}: {response.text}")
+            return None
+
+    except httpx.HTTPError as e:
+        print(f"Error while calling the tickets API: {e}")
+        return None
+
+
+async def ticket_cancel(telegram_user_id, ticket_id):
+    user = await get_user_by_user_id(telegram_user_id)
+    payload = {
+        "status_name": "cancelled"
+    }
+    headers = {"Authorization": f"Bearer {user['token']}"}
+    try:
+        response = await api_post("/tickets/" + ticket_id + "/status", json=payload, headers=headers)
+        invalidate_user_tickets(telegram_user_id)
+        if response.status_code == 200:
+            return True
+        else:
+            print(f"Failed to cancel ticket: {response.status_code}: {response.text}")
+            return False
+    except httpx.HTTPError as e:
+        print(f"Error while calling the cancel ticket API: {e}")
+        return False
+
+
+async def ticket_book(telegram_user_id, ticket_id):
+    user = await get_user_by_user_id(telegram_user_id)
+    payload = {
+        "status_name": "booked"
+    }
+    headers = {"Authorization": f"Bearer {user['token']}"}
+    try:
+        response = await api_post("/tickets/" + ticket_id + "/status", json=payload, headers=headers)
+        invalidate_user_tickets(telegram_user_id)
+        return response.status_code == 200
+    except httpx.HTTPError as e:
+        print(f"Error while calling the book ticket API: {e}")
+        return False
+
+
+async def ticket_info(telegram_user_id, ticket_id):
+    user = await get_user_by_user_id(telegram_user_id)
+    headers = {"Authorization": f"Bearer {user['token']}"}
+    try:
+        response = await api_get("/tickets/" + ticket_id, headers=headers)
+        if response.status_code == 200:
+            return response.json()
+        else:
+            print(f"Failed to get ticket: {response.status_code}: {response.text}")
+            return None
+    except httpx.HTTPError as e:
+        print(f"Error while calling the ticket API: {e}")
+        return None
+
+
+async def event_info(event_id):
+    return await read_flights.do(("event", event_id), fetch_event_info, event_id)
+
+
+async def fetch_event_info(event_id):
+    try:
+        response = await api_get("/events/" + event_id)
+        if response.status_code == 200:
+            return response.json()
+        else:
+            print(f"Failed to fetch event: {response.status_code}: {response.text}")
+            return None
+    except httpx.HTTPError as e:
+        print(f"Error while calling the event API: {e}")
+        return None
+
+
+async def location_info(location_id):
+    location_data = await run_in_db_thread(get_cached_location, location_id)
+    if location_data is not None:
+        return location_data
+    return await read_flights.do(("location", location_id), fetch_location_info, location_id)
+
+
+async def fetch_location_info(location_id):
+    try:
+        response = await api_get("/locations/" + location_id)
+        if response.status_code == 200:
+            location_data = response.json()
+            await run_in_db_thread(cache_location, location_id, location_data)
+            return location_data
+        else:
+            print(f"Failed to fetch location: {response.status_code}: {response.text}")
+            return None
+    except httpx.HTTPError as e:
+        print(f"Error while calling the location API: {e}")
+        return None
+
+
+async def locations_info(location_ids):
+    locations, missing = await run_in_db_thread(get_cached_locations, list(location_ids))
+    fetched = await asyncio.gather(*(location_info(location_id) for location_id in missing))
+    locations.update({location_id: location_data for location_id, location_data in zip(missing, fetched)
+                      if location_data is not None})
+    return locations
+
+
+async def register_event(event_id, telegram_user_id):
+    user = await get_user_by_user_id(telegram_user_id)
+    payload = register_payload(event_id, user)
+    headers = {"Authorization": f"Bearer {user['token']}"}
+    try:
+        response = await api_post("/tickets", json=payload, headers=headers)
+        invalidate_user_tickets(telegram_user_id)
+        if response.status_code == 200:
+            print(f"Registering event {event_id}, user: {telegram_user_id}")
+            invalidate_events_cache(event_id)
+            return response.json()
+        else:
+            print(f"Failed to register event: {response.status_code}: {response.text}")
+            return None
+    except httpx.HTTPError as e:
+        print(f"Error while calling the tickets API: {e}")
+        return None
+
+
+async def events(city, dayOfWeek=None, start_date=None, end_date=None, limit=200, skip=0):
+    params = events_params(city, dayOfWeek, start_date, end_date, limit, skip)
+    cache_key = events_cache_key(params)
+    event_data = events_cache.get(cache_key)
+    if event_data is not None:
+        return event_data
+    return await read_flights.do(("events", *cache_key), fetch_events, params, cache_key)
+
+
+async def fetch_events(params, cache_key):
+    try:
+        response = await api_get("/events/", params=params)
+        if response.status_code == 200:
+            event_data = response.json()
+            events_cache.set(cache_key, event_data)
+            return event_data
+        else:
+            print(f"Failed to fetch event: {response.status_code}: {response.text}")
+            return None
+    except httpx.HTTPError as e:
+        print(f"Error while calling the event API: {e}")
+        return None
+
+
+async def iter_pages(fetch_page, strict=False):
+    # Yields the records of each page while the next page is already being fetched,
+    # a failed page ends the iteration, or raises when the caller needs the complete listing
+    next_page = asyncio.ensure_future(fetch_page(0))
+    skip = 0
+    try:
+        while next_page is not None:
+            page = await next_page
+            next_page = None
+            if page is None:
+                if strict:
+                    raise IncompletePagesException(f"Failed to fetch the page at offset {skip}")
+                return
+            page_data = page.get('data', [])
+            skip += len(page_data)
+            if page_data and skip < page.get('total', 0):
+                next_page = asyncio.ensure_future(fetch_page(skip))
+            for record in page_data:
+                yield record
+    finally:
+        if next_page is not None:
+            next_page.cancel()
+
+
+def iter_events(city, start_date, end_date, page_size=200):
+    return iter_pages(lambda skip: events(city, start_date=start_date, end_date=end_date, limit=page_size, skip=skip))
+
+
+def iter_tickets(telegram_user_id, page_size=30):
+    since = datetime.now()
+    return iter_pages(lambda skip: tickets(telegram_user_id, limit=page_size, skip=skip, since=since), strict=True)
+
+
+async def user_tickets(telegram_user_id):
+    # Upcoming tickets by id, the list response already embeds each ticket's event and location.
+    # Raises IncompletePagesException when a page failed, an incomplete listing is never cached.
+    cache_key = str(telegram_user_id)
+    cached_tickets = ticket_cache.get(cache_key)
+    if cached_tickets is not None:
+        return cached_tickets
+    return await read_flights.do(("tickets", cache_key), fetch_user_tickets, telegram_user_id)
+
+
+async def fetch_user_tickets(telegram_user_id):
+    cache_key = str(telegram_user_id)
+    generation = ticket_generations.get(cache_key, 0)
+    cached_tickets = {ticket.get('id'): ticket async for ticket in iter_tickets(telegram_user_id)}
+    # Skipped when the user booked or cancelled meanwhile, the listing may predate that change
+    if ticket_generations.get(cache_key, 0) == generation:
+        ticket_cache.set(cache_key, cached_tickets)
+    return cached_tickets
+
+
+async def user_ticket(telegram_user_id, ticket_id):
+    try:
+        ticket = (await user_tickets(telegram_user_id)).get(ticket_id)
+    except IncompletePagesException:
+        ticket = None
+    if ticket is not None:
+        return ticket
+    # Not in the upcoming list, e.g. the event already started
+    ticket_response = await ticket_info(telegram_user_id, ticket_id)
+    return ticket_response.get('data') if ticket_response else None
+
+
+async def events_range(city, start_date, end_date, page_size=200):
+    # The first page tells the total, the remaining pages are fetched concurrently
+    first_page = await events(city, start_date=start_date, end_date=end_date, limit=page_size)
+    if first_page is None:
+        return None
+    all_events = list(first_page.get('data', []))
+    skips = range(page_size, first_page.get('total', 0), page_size)
+    pages = await asyncio.gather(*(events(city, start_date=start_date, end_date=end_date, limit=page_size, skip=skip)
+                                   for skip in skips))
+    for page in pages:
+        if page is None:
+            return None
+        all_events.extend(page.get('data', []))
+    return all_events
+
+
+async def register_series(event_id, telegram_user_id):
+    # Returns (booked, series size, whether the upcoming events could be listed), without the listing
+    # only the chosen event is registered and the subscription books the rest later
+    event_data = (await event_info(event_id)).get('data')
+    city, location_id, date = await run_in_db_thread(save_series_subscription, event_data, telegram_user_id)
+    all_events = await events_range(city, date, get_date_after(21))
+    series = series_events(all_events or [event_data], event_data)
+    results = await asyncio.gather(*(register_event(event.get('id'), telegram_user_id) for event in series))
+    booked = sum(result is not None for result in results)
+    return booked, len(series), all_events is not None
@@ -36,6 +36,10 @@ def get_date_cet(iso_date):
     return date_begin_utc.astimezone(ZoneInfo("Europe/Berlin"))
 
 
+def get_timestamp_from_string(iso_date):
+    return int(get_date_cet(iso_date).timestamp()) if iso_date else None
+
+
 def get_weekday_form_date(iso_date):
     date_begin = get_date_cet(iso_date)
     return date_begin.strftime("%A").lower()
@@ -58,6 +62,12 @@ def next_date_to_day(day_of_week):
     return next_date
 
 
+def get_date_time_utc(day, hour, minute):
+    # A Berlin wall clock time on the given day, so weekly slots keep their local time across DST changes
+    return datetime(day.year, day.month, day.day, hour, minute, tzinfo=ZoneInfo("Europe/Berlin")).astimezone(
+        ZoneInfo("UTC"))
+
+
 def next_date_time_weekday(day_of_week, hour, minute, second=0):
     next_date = next_date_to_day(day_of_week)
     next_date_time = datetime(next_date.year, next_date.month, next_date.day, hour, minute, second).astimezone(
@@ -1,85 +1,258 @@
+import json
 import os
 import sqlite3
+import threading
+import time
+from contextlib import contextmanager
 from datetime import datetime
 
-DATA_DIRECTORY = "data"
+from beat81.cache_helper import TTLCache
+
+DATA_DIRECTORY = os.getenv("DATA_DIRECTORY", "data")
 DATABASE_FILE = os.path.join(DATA_DIRECTORY, "user_data.db")
 
+BUSY_TIMEOUT_SECONDS = float(os.getenv("DB_BUSY_TIMEOUT", 10))
+STATEMENT_CACHE_SIZE = 256
+
 if not os.path.exists(DATA_DIRECTORY):
     os.makedirs(DATA_DIRECTORY)
 
+thread_connections = threading.local()
+
+# Users by telegram id, save_user and clear_token invalidate their entry. The TTL bounds staleness
+# when another process changes the users table.
+user_cache = TTLCache(maxsize=int(os.getenv("USER_CACHE_SIZE", 1024)), ttl=float(os.getenv("USER_CACHE_TTL", 300)))
+MISSING = object()
+
+
+def get_connection():
+    # One long-lived connection per thread, so its prepared statement cache is reused across queries
+    conn = getattr(thread_connections, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(DATABASE_FILE, timeout=BUSY_TIMEOUT_SECONDS, cached_statements=STATEMENT_CACHE_SIZE)
+        conn.execute("PRAGMA journal_mode = WAL;")
+        conn.execute("PRAGMA synchronous = NORMAL;")
+        conn.execute("PRAGMA foreign_keys = ON;")
+        thread_connections.conn = conn
+    return conn
+
+
+def close_connection():
+    conn = getattr(thread_connections, "conn", None)
+    if conn is not None:
+        conn.close()
+        thread_connections.conn = None
+
+
+@contextmanager
+def transaction():
+    conn = get_connection()
+    if conn.in_transaction:
+        # Nested use joins the outer transaction
+        yield conn.cursor()
+        return
+    # IMMEDIATE takes the write lock up front instead of failing on a lock upgrade
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn.cursor()
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
 
-def init_db():
-    with sqlite3.connect(DATABASE_FILE) as conn:
-        cursor = conn.cursor()
-        cursor.execute("PRAGMA foreign_keys = ON;")
-
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                telegram_user_id TEXT NOT NULL UNIQUE,
-                beat81_user_id TEXT NOT NULL UNIQUE,
-                email TEXT NOT NULL UNIQUE,
-                token TEXT,
-                first_name TEXT,
-                last_name TEXT,
-                creation_time DATETIME DEFAULT CURRENT_TIMESTAMP,
-                last_login_date DATETIME,
-                UNIQUE (telegram_user_id, beat81_user_id)
-            )
-        ''')
 
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS subscriptions (
+@contextmanager
+def read_cursor():
+    cursor = get_connection().cursor()
+    try:
+        yield cursor
+    finally:
+        cursor.close()
+
+
+def create_initial_tables(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            telegram_user_id TEXT NOT NULL UNIQUE,
+            beat81_user_id TEXT NOT NULL UNIQUE,
+            email TEXT NOT NULL UNIQUE,
+            token TEXT,
+            first_name TEXT,
+            last_name TEXT,
+            creation_time DATETIME DEFAULT CURRENT_TIMESTAMP,
+            last_login_date DATETIME,
+            UNIQUE (telegram_user_id, beat81_user_id)
+        )
+    ''')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS subscriptions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            telegram_user_id TEXT NOT NULL,
+            location_id TEXT NOT NULL,
+            city TEXT NOT NULL,
+            day_of_week TEXT NOT NULL,
+            time TEXT NOT NULL,
+            creation_time DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (user_id),
+            UNIQUE (user_id, location_id, day_of_week, time)
+        )
+    ''')
+
+    cursor.execute('''
+            CREATE TABLE IF NOT EXISTS autojoins (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 user_id INTEGER NOT NULL,
                 telegram_user_id TEXT NOT NULL,
-                location_id TEXT NOT NULL,
-                city TEXT NOT NULL,
-                day_of_week TEXT NOT NULL,
-                time TEXT NOT NULL,
+                ticket_id TEXT NOT NULL,
+                event_id TEXT NOT NULL,
                 creation_time DATETIME DEFAULT CURRENT_TIMESTAMP,
                 FOREIGN KEY (user_id) REFERENCES users (user_id),
-                UNIQUE (user_id, location_id, day_of_week, time)
+                UNIQUE (user_id, event_id)
             )
-        ''')
-
-        cursor.execute('''
-                CREATE TABLE IF NOT EXISTS autojoins (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER NOT NULL,
-                    telegram_user_id TEXT NOT NULL,
-                    ticket_id TEXT NOT NULL,
-                    event_id TEXT NOT NULL,
-                    creation_time DATETIME DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (user_id) REFERENCES users (user_id),
-                    UNIQUE (user_id, event_id)
-                )
-        ''')
+    ''')
+
+    cursor.execute('''
+            CREATE TABLE IF NOT EXISTS locations (
+                location_id TEXT PRIMARY KEY,
+                data TEXT NOT NULL,
+                update_time DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+    ''')
+
+
+def fix_user_foreign_keys(cursor):
+    # The original tables referenced the non-existent users (user_id), SQLite needs a table rebuild to change that
+    cursor.execute('''
+        CREATE TABLE subscriptions_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            telegram_user_id TEXT NOT NULL,
+            location_id TEXT NOT NULL,
+            city TEXT NOT NULL,
+            day_of_week TEXT NOT NULL,
+            time TEXT NOT NULL,
+            creation_time DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id),
+            UNIQUE (user_id, location_id, day_of_week, time)
+        )
+    ''')
+
+    cursor.execute('''
+        CREATE TABLE autojoins_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            telegram_user_id TEXT NOT NULL,
+            ticket_id TEXT NOT NULL,
+            event_id TEXT NOT NULL,
+            creation_time DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id),
+            UNIQUE (user_id, event_id)
+        )
+    ''')
+
+    for table in ("subscriptions", "autojoins"):
+        cursor.execute(f"INSERT INTO {table}_new SELECT * FROM {table} WHERE user_id IN (SELECT id FROM users)")
+        orphans = cursor.execute(f"SELECT COUNT(*) FROM {table} WHERE user_id NOT IN (SELECT id FROM users)")
+        orphan_count = orphans.fetchone()[0]
+        if orphan_count:
+            print(f"Dropped {orphan_count} {table} rows without a matching user.")
+        cursor.execute(f"DROP TABLE {table}")
+        cursor.execute(f"ALTER TABLE {table}_new RENAME TO {table}")
+
+
+def add_lookup_indexes(cursor):
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_subscriptions_telegram_user_id ON subscriptions (telegram_user_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_autojoins_telegram_user_id ON autojoins (telegram_user_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_autojoins_event_id ON autojoins (event_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_autojoins_ticket_id ON autojoins (ticket_id)")
+
+
+def add_token_expiry(cursor):
+    cursor.execute("ALTER TABLE users ADD COLUMN token_exp INTEGER")
+    cursor.execute("ALTER TABLE users ADD COLUMN relogin_notice TEXT")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_token_exp ON users (token_exp)")
+
+
+def add_job_leases(cursor):
+    # One row per job shard, held by one worker process until it expires or the run completes
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS job_leases (
+        job TEXT NOT NULL,
+        shard INTEGER NOT NULL,
+        owner TEXT,
+        expires_at INTEGER NOT NULL DEFAULT 0,
+        last_run TEXT,
+        PRIMARY KEY (job, shard)
+    )
+    ''')
+
+
+def add_auto_join_schedule(cursor):
+    # Event start as unix time, filled on the first check when unknown at save time
+    cursor.execute("ALTER TABLE autojoins ADD COLUMN event_start INTEGER")
+    cursor.execute("ALTER TABLE autojoins ADD COLUMN next_check_time INTEGER")
+    cursor.execute("ALTER TABLE autojoins ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0")
+    cursor.execute("ALTER TABLE autojoins ADD COLUMN last_participants_count INTEGER")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_autojoins_next_check_time ON autojoins (next_check_time)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_autojoins_event_start ON autojoins (event_start)")
+
+
+# Ordered schema migrations, the position in this list is the schema version. Only ever append to it.
+MIGRATIONS = [
+    create_initial_tables,
+    fix_user_foreign_keys,
+    add_lookup_indexes,
+    add_token_expiry,
+    add_job_leases,
+    add_auto_join_schedule,
+]
 
-        conn.commit()
+
+def init_db():
+    conn = get_connection()
+    # Table rebuilds must not trigger foreign key actions, and the pragma is a no-op inside a transaction
+    conn.execute("PRAGMA foreign_keys = OFF;")
+    try:
+        for version, migration in enumerate(MIGRATIONS, start=1):
+            with transaction() as cursor:
+                # Re-read inside the write lock in case another process migrated in the meantime
+                if cursor.execute("PRAGMA user_version").fetchone()[0] >= version:
+                    continue
+                migration(cursor)
+                cursor.execute(f"PRAGMA user_version = {version}")
+            print(f"Applied database migration {version}: {migration.__name__}")
+        violations = conn.execute("PRAGMA foreign_key_check").fetchall()
+        if violations:
+            print(f"Foreign key violations after migrations: {violations}")
+    finally:
+        conn.execute("PRAGMA foreign_keys = ON;")
 
 
 def save_user(telegram_user_id, beat81_user_id, email, token, first_name, last_name, creation_time=datetime.now(),
-              last_login_date=datetime.now()):
+              last_login_date=datetime.now(), token_exp=None):
     try:
-        with sqlite3.connect(DATABASE_FILE) as conn:
-            cursor = conn.cursor()
+        with transaction() as cursor:
             cursor.execute('''
-            INSERT INTO users (telegram_user_id, beat81_user_id, email, token, first_name, last_name, creation_time, last_login_date)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            INSERT INTO users (telegram_user_id, beat81_user_id, email, token, first_name, last_name, creation_time, last_login_date, token_exp)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
             ON CONFLICT(telegram_user_id) DO UPDATE SET
                     beat81_user_id = excluded.beat81_user_id,
                     email = excluded.email,
                     token = excluded.token,
                     first_name = excluded.first_name,
                     last_name = excluded.last_name,
-                    last_login_date = excluded.last_login_date
+                    last_login_date = excluded.last_login_date,
+                    token_exp = excluded.token_exp,
+                    relogin_notice = NULL
             ''', (
-                telegram_user_id, beat81_user_id, email, token, first_name, last_name, creation_time, last_login_date))
-            conn.commit()
-            print(f"User {email} saved successfully.")
-            return True
+                telegram_user_id, beat81_user_id, email, token, first_name, last_name, creation_time, last_login_date,
+                token_exp))
+        user_cache.delete(str(telegram_user_id))
+        print(f"User {email} saved successfully.")
+        return True
     except sqlite3.IntegrityError:
         print(f"User {email} already exists in the database.")
         return False
@@ -88,40 +261,160 @@ def save_user(telegram_user_id, beat81_user_id, email, token, first_name, last_n
 def save_subscription(telegram_user_id, location_id, city, day_of_week, time, creation_time=datetime.now()):
     user = get_user_by_user_id(telegram_user_id)
     try:
-        with sqlite3.connect(DATABASE_FILE) as conn:
-            cursor = conn.cursor()
+        with transaction() as cursor:
             cursor.execute('''
             INSERT INTO subscriptions (user_id, telegram_user_id, location_id, city, day_of_week, time, creation_time)
             VALUES (?, ?, ?, ?, ?, ?, ?)
             ''', (user['id'], telegram_user_id, location_id, city.name, day_of_week, time, creation_time))
-            conn.commit()
             return True
     except sqlite3.IntegrityError:
         print(f"Subscription {user['id']}, {location_id}, {day_of_week}, {time} already exists in the database.")
         return False
 
 
-def save_auto_join(telegram_user_id, ticket_id, event_id, creation_time=datetime.now()):
+def save_auto_join(telegram_user_id, ticket_id, event_id, creation_time=datetime.now(), event_start=None):
     user = get_user_by_user_id(telegram_user_id)
     try:
-        with sqlite3.connect(DATABASE_FILE) as conn:
-            cursor = conn.cursor()
+        with transaction() as cursor:
             cursor.execute('''
-            INSERT INTO autojoins (user_id, telegram_user_id, ticket_id, event_id, creation_time)
-            VALUES (?, ?, ?, ?, ?)
-            ''', (user['id'], telegram_user_id, ticket_id, event_id, creation_time))
-            conn.commit()
+            INSERT INTO autojoins (user_id, telegram_user_id, ticket_id, event_id, creation_time, event_start)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ''', (user['id'], telegram_user_id, ticket_id, event_id, creation_time, event_start))
             return True
     except sqlite3.IntegrityError:
         print(f"auto join {user['id']}, {ticket_id}, {event_id} already exists in the database.")
         return False
 
 
-def get_user_by_email(email):
+def save_subscriptions(subscriptions, creation_time=None):
+    # Rows are (telegram_user_id, location_id, city, day_of_week, time), written in a single transaction
+    creation_time = creation_time or datetime.now()
+    subscriptions = [(str(row[0]), *row[1:]) for row in subscriptions]
+    try:
+        with transaction() as cursor:
+            users = get_users_by_user_ids(cursor, {row[0] for row in subscriptions})
+            existing = set()
+            for user_ids in chunks([user['id'] for user in users.values()]):
+                placeholders = ", ".join("?" for _ in user_ids)
+                cursor.execute(f'''
+                SELECT user_id, location_id, day_of_week, time FROM subscriptions WHERE user_id IN ({placeholders})
+                ''', user_ids)
+                existing.update(cursor.fetchall())
+
+            inserted, duplicates, values = [], [], []
+            for row in subscriptions:
+                telegram_user_id, location_id, city, day_of_week, time = row
+                user = users.get(telegram_user_id)
+                if user is None:
+                    print(f"Skipping subscription for unknown user {telegram_user_id}.")
+                    continue
+                key = (user['id'], location_id, day_of_week, time)
+                if key in existing:
+                    duplicates.append(row)
+                    continue
+                existing.add(key)
+                inserted.append(row)
+                values.append((user['id'], telegram_user_id, location_id, city.name, day_of_week, time, creation_time))
+
+            cursor.executemany('''
+            INSERT INTO subscriptions (user_id, telegram_user_id, location_id, city, day_of_week, time, creation_time)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', values)
+            return inserted, duplicates
+    except Exception as e:
+        print(f"An error occurred while saving subscriptions: {e}")
+        return [], []
+
+
+def save_auto_joins(auto_joins, creation_time=None):
+    # Rows are (telegram_user_id, ticket_id, event_id), written in a single transaction
+    creation_time = creation_time or datetime.now()
+    auto_joins = [(str(row[0]), *row[1:]) for row in auto_joins]
     try:
-        with sqlite3.connect(DATABASE_FILE) as conn:
-            cursor = conn.cursor()
+        with transaction() as cursor:
+            users = get_users_by_user_ids(cursor, {row[0] for row in auto_joins})
+            existing = set()
+            for user_ids in chunks([user['id'] for user in users.values()]):
+                placeholders = ", ".join("?" for _ in user_ids)
+                cursor.execute(f'''
+                SELECT user_id, event_id FROM autojoins WHERE user_id IN ({placeholders})
+                ''', user_ids)
+                existing.update(cursor.fetchall())
+
+            inserted, duplicates, values = [], [], []
+            for row in auto_joins:
+                telegram_user_id, ticket_id, event_id = row
+                user = users.get(telegram_user_id)
+                if user is None:
+                    print(f"Skipping auto join for unknown user {telegram_user_id}.")
+                    continue
+                key = (user['id'], event_id)
+                if key in existing:
+                    duplicates.append(row)
+                    continue
+                existing.add(key)
+                inserted.append(row)
+                values.append((user['id'], telegram_user_id, ticket_id, event_id, creation_time))
+
+            cursor.executemany('''
+            INSERT INTO autojoins (user_id, telegram_user_id, ticket_id, event_id, creation_time)
+            VALUES (?, ?, ?, ?, ?)
+            ''', values)
+            return inserted, duplicates
+    except Exception as e:
+        print(f"An error occurred while saving auto joins: {e}")
+        return [], []
+
+
+def get_users_by_user_ids(cursor, telegram_user_ids):
+    users = {}
+    for user_ids in chunks([str(telegram_user_id) for telegram_user_id in telegram_user_ids]):
+        placeholders = ", ".join("?" for _ in user_ids)
+        cursor.execute(f'''
+        SELECT * FROM users WHERE telegram_user_id IN ({placeholders})
+        ''', user_ids)
+        users.update({user['telegram_user_id']: user for user in fetchall_as_json(cursor)})
+    return users
+
 
+def save_location(location_id, data, update_time=None):
+    try:
+        with transaction() as cursor:
+            cursor.execute('''
+            INSERT INTO locations (location_id, data, update_time)
+            VALUES (?, ?, ?)
+            ON CONFLICT(location_id) DO UPDATE SET
+                    data = excluded.data,
+                    update_time = excluded.update_time
+            ''', (location_id, json.dumps(data), update_time or datetime.now()))
+            return True
+    except Exception as e:
+        print(f"An error occurred while saving location {location_id}: {e}")
+        return False
+
+
+def get_locations(location_ids, updated_after):
+    location_ids = list(location_ids)
+    if not location_ids:
+        return {}
+    try:
+        with read_cursor() as cursor:
+            placeholders = ", ".join("?" for _ in location_ids)
+
+            cursor.execute(f'''
+            SELECT location_id, data FROM locations WHERE location_id IN ({placeholders}) AND update_time >= ?
+            ''', (*location_ids, updated_after))
+
+            return {row['location_id']: json.loads(row['data']) for row in fetchall_as_json(cursor)}
+
+    except Exception as e:
+        print(f"An error occurred while fetching locations: {e}")
+        return {}
+
+
+def get_user_by_email(email):
+    try:
+        with read_cursor() as cursor:
             cursor.execute('''
             SELECT * FROM users WHERE email = ?
             ''', (email,))
@@ -135,15 +428,19 @@ def get_user_by_email(email):
 
 def get_user_by_user_id(telegram_user_id):
     telegram_user_id = str(telegram_user_id)
+    user = user_cache.get(telegram_user_id, MISSING)
+    if user is not MISSING:
+        return dict(user) if user else None
     try:
-        with sqlite3.connect(DATABASE_FILE) as conn:
-            cursor = conn.cursor()
-
+        with read_cursor() as cursor:
             cursor.execute('''
             SELECT * FROM users WHERE telegram_user_id = ?
             ''', (telegram_user_id,))
 
-            return fetchone_as_json(cursor)
+            user = fetchone_as_json(cursor)
+            # Unknown users are cached too, main_menu_keyboard looks them up on every tap
+            user_cache.set(telegram_user_id, user)
+            return dict(user) if user else None
 
     except Exception as e:
         print(f"An error occurred while fetching user by telegram_user_id: {telegram_user_id}, {e}")
@@ -152,9 +449,7 @@ def get_user_by_user_id(telegram_user_id):
 
 def get_all_subscriptions():
     try:
-        with sqlite3.connect(DATABASE_FILE) as conn:
-            cursor = conn.cursor()
-
+        with read_cursor() as cursor:
             cursor.execute('''
             SELECT * FROM subscriptions
             ''')
@@ -168,9 +463,7 @@ def get_all_subscriptions():
 
 def get_all_auto_joins():
     try:
-        with sqlite3.connect(DATABASE_FILE) as conn:
-            cursor = conn.cursor()
-
+        with read_cursor() as cursor:
             cursor.execute('''
             SELECT * FROM autojoins
             ''')
@@ -182,12 +475,120 @@ def get_all_auto_joins():
         return None
 
 
-def get_user_subscriptions(telegram_user_id):
+def get_active_subscriptions(now=None, shard=0, shards=1):
+    # Subscriptions of one user id shard whose user's token is present and not expired,
+    # unknown expiry counts as valid
+    try:
+        with read_cursor() as cursor:
+            cursor.execute('''
+            SELECT subscriptions.* FROM subscriptions JOIN users ON users.id = subscriptions.user_id
+            WHERE abs(CAST(subscriptions.telegram_user_id AS INTEGER)) % ? = ?
+            AND users.token IS NOT NULL AND (users.token_exp IS NULL OR users.token_exp > ?)
+            ''', (shards, shard, now or int(time.time())))
+
+            return fetchall_as_json(cursor)
+
+    except Exception as e:
+        print(f"An error occurred while fetching active subscriptions: {e}")
+        return None
+
+
+def get_due_auto_joins(now=None, shard=0, shards=1):
+    # Active auto joins of one user id shard whose next check is due, new rows have no next check yet
+    now = now or int(time.time())
+    try:
+        with read_cursor() as cursor:
+            cursor.execute('''
+            SELECT autojoins.* FROM autojoins JOIN users ON users.id = autojoins.user_id
+            WHERE (autojoins.next_check_time IS NULL OR autojoins.next_check_time <= ?)
+            AND abs(CAST(autojoins.telegram_user_id AS INTEGER)) % ? = ?
+            AND users.token IS NOT NULL AND (users.token_exp IS NULL OR users.token_exp > ?)
+            ''', (now, shards, shard, now))
+
+            return fetchall_as_json(cursor)
+
+    except Exception as e:
+        print(f"An error occurred while fetching due auto joins: {e}")
+        return None
+
+
+def update_auto_join_checks(checks):
+    # checks: (auto_join_id, event_start, next_check_time, attempts, last_participants_count)
+    try:
+        with transaction() as cursor:
+            cursor.executemany('''
+            UPDATE autojoins SET event_start = ?, next_check_time = ?, attempts = ?, last_participants_count = ?
+            WHERE id = ?
+            ''', [(event_start, next_check_time, attempts, participants_count, auto_join_id)
+                  for auto_join_id, event_start, next_check_time, attempts, participants_count in checks])
+            return True
+    except Exception as e:
+        print(f"An error occurred while updating auto join checks: {e}")
+        return False
+
+
+def retire_past_auto_joins(now=None):
+    # Auto joins of events that already started can never be booked anymore
+    try:
+        with transaction() as cursor:
+            cursor.execute('DELETE FROM autojoins WHERE event_start <= ?', (now or int(time.time()),))
+            return cursor.rowcount
+    except Exception as e:
+        print(f"An error occurred while retiring past auto joins: {e}")
+        return 0
+
+
+def queue_relogin_notices(now=None):
+    # Users with expired tokens and pending jobs get a single "please log in again" notice
+    try:
+        with transaction() as cursor:
+            cursor.execute('''
+            UPDATE users SET relogin_notice = 'pending'
+            WHERE token IS NOT NULL AND token_exp <= ? AND relogin_notice IS NULL
+            AND (id IN (SELECT user_id FROM subscriptions) OR id IN (SELECT user_id FROM autojoins))
+            ''', (now or int(time.time()),))
+            return cursor.rowcount
+    except Exception as e:
+        print(f"An error occurred while queueing relogin notices: {e}")
+        return 0
+
+
+def get_pending_relogin_notices():
+    try:
+        with read_cursor() as cursor:
+            cursor.execute('''
+            SELECT telegram_user_id FROM users WHERE relogin_notice = 'pending'
+            ''')
+
+            return [row['telegram_user_id'] for row in fetchall_as_json(cursor)]
+
+    except Exception as e:
+        print(f"An error occurred while fetching relogin notices: {e}")
+        return []
+
+
+def mark_relogin_notice_sent(telegram_user_id):
     telegram_user_id = str(telegram_user_id)
     try:
-        with sqlite3.connect(DATABASE_FILE) as conn:
-            cursor = conn.cursor()
+        with transaction() as cursor:
+            cursor.execute("UPDATE users SET relogin_notice = 'sent' WHERE telegram_user_id = ?", (telegram_user_id,))
+        user_cache.delete(telegram_user_id)
+        return True
+    except Exception as e:
+        print(f"An error occurred while marking relogin notice: {e}")
+        return False
 
+
+def is_token_valid(user, now=None):
+    if not user or not user.get('token'):
+        return False
+    return user.get('token_exp') is None or user.get('token_exp') > (now or time.time())
+
+
+def get_user_subscriptions(telegram_user_id):
+    telegram_user_id = str(telegram_user_id)
+    try:
+        with read_cursor() as cursor:
             cursor.execute('''
             SELECT * FROM subscriptions WHERE telegram_user_id = ?
             ''', (telegram_user_id,))
@@ -202,9 +603,7 @@ def get_user_subscriptions(telegram_user_id):
 def get_user_auto_joins(telegram_user_id):
     telegram_user_id = str(telegram_user_id)
     try:
-        with sqlite3.connect(DATABASE_FILE) as conn:
-            cursor = conn.cursor()
-
+        with read_cursor() as cursor:
             cursor.execute('''
             SELECT * FROM autojoins WHERE telegram_user_id = ?
             ''', (telegram_user_id,))
@@ -218,9 +617,7 @@ def get_user_auto_joins(telegram_user_id):
 
 def get_subscription_by_id(subscription_id):
     try:
-        with sqlite3.connect(DATABASE_FILE) as conn:
-            cursor = conn.cursor()
-
+        with read_cursor() as cursor:
             cursor.execute('''
             SELECT * FROM subscriptions WHERE id = ?
             ''', (subscription_id,))
@@ -234,9 +631,7 @@ def get_subscription_by_id(subscription_id):
 
 def get_auto_join_by_id(auto_join_id):
     try:
-        with sqlite3.connect(DATABASE_FILE) as conn:
-            cursor = conn.cursor()
-
+        with read_cursor() as cursor:
             cursor.execute('''
             SELECT * FROM autojoins WHERE id = ?
             ''', (auto_join_id,))
@@ -250,9 +645,7 @@ def get_auto_join_by_id(auto_join_id):
 
 def get_auto_join_by_event_id(event_id):
     try:
-        with sqlite3.connect(DATABASE_FILE) as conn:
-            cursor = conn.cursor()
-
+        with read_cursor() as cursor:
             cursor.execute('''
             SELECT * FROM autojoins WHERE event_id = ?
             ''', (event_id,))
@@ -266,10 +659,8 @@ def get_auto_join_by_event_id(event_id):
 
 def cancel_subscription(subscription_id):
     try:
-        with sqlite3.connect(DATABASE_FILE) as conn:
-            cursor = conn.cursor()
+        with transaction() as cursor:
             cursor.execute('DELETE FROM subscriptions WHERE id = ?', (subscription_id,))
-            conn.commit()
             return True
     except Exception as e:
         print(f"An error occurred while cancelling subscription: {e}")
@@ -278,10 +669,8 @@ def cancel_subscription(subscription_id):
 
 def cancel_auto_join(auto_join_id):
     try:
-        with sqlite3.connect(DATABASE_FILE) as conn:
-            cursor = conn.cursor()
+        with transaction() as cursor:
             cursor.execute('DELETE FROM autojoins WHERE id = ?', (auto_join_id,))
-            conn.commit()
             return True
     except Exception as e:
         print(f"An error occurred while cancelling auto join: {e}")
@@ -290,10 +679,8 @@ def cancel_auto_join(auto_join_id):
 
 def delete_auto_join_by_ticket_id(ticket_id):
     try:
-        with sqlite3.connect(DATABASE_FILE) as conn:
-            cursor = conn.cursor()
+        with transaction() as cursor:
             cursor.execute('DELETE FROM autojoins WHERE ticket_id = ?', (ticket_id,))
-            conn.commit()
             return True
     except Exception as e:
         print(f"An error occurred while deleting auto join: {e}")
@@ -303,17 +690,62 @@ def delete_auto_join_by_ticket_id(ticket_id):
 def clear_token(telegram_user_id):
     telegram_user_id = str(telegram_user_id)
     try:
-        with sqlite3.connect(DATABASE_FILE) as conn:
-            cursor = conn.cursor()
-
+        with transaction() as cursor:
             cursor.execute('Update users SET token = NULL WHERE telegram_user_id = ?', (telegram_user_id,))
-        conn.commit()
+        user_cache.delete(telegram_user_id)
         return True
     except Exception as e:
         print(f"An error occurred while clearing token: {e}")
         return False
 
 
+def acquire_lease(job, shard, owner, run, ttl, now=None):
+    # Free, expired or already ours, and the shard was not completed for this run yet
+    now = now or int(time.time())
+    try:
+        with transaction() as cursor:
+            cursor.execute('''
+            INSERT INTO job_leases (job, shard, owner, expires_at) VALUES (?, ?, ?, ?)
+            ON CONFLICT (job, shard) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at
+            WHERE (job_leases.owner IS NULL OR job_leases.owner = excluded.owner OR job_leases.expires_at <= ?)
+            AND (job_leases.last_run IS NULL OR job_leases.last_run < ?)
+            ''', (job, shard, owner, now + ttl, now, run))
+            return cursor.rowcount == 1
+    except Exception as e:
+        print(f"An error occurred while acquiring lease {job}/{shard}: {e}")
+        return False
+
+
+def renew_lease(job, shard, owner, ttl, now=None):
+    now = now or int(time.time())
+    try:
+        with transaction() as cursor:
+            cursor.execute('''
+            UPDATE job_leases SET expires_at = ? WHERE job = ? AND shard = ? AND owner = ?
+            ''', (now + ttl, job, shard, owner))
+            return cursor.rowcount == 1
+    except Exception as e:
+        print(f"An error occurred while renewing lease {job}/{shard}: {e}")
+        return False
+
+
+def complete_lease(job, shard, owner, run):
+    try:
+        with transaction() as cursor:
+            cursor.execute('''
+            UPDATE job_leases SET owner = NULL, expires_at = 0, last_run = ? WHERE job = ? AND shard = ? AND owner = ?
+            ''', (run, job, shard, owner))
+    except Exception as e:
+        print(f"An error occurred while completing lease {job}/{shard}: {e}")
+
+
+def chunks(values, size=500):
+    # Keeps IN (...) lists below SQLite's bound parameter limit
+    values = list(values)
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
+
+
 def fetchall_as_json(cursor):
     rows = cursor.fetchall()
     columns = [desc[0] for desc in cursor.description]
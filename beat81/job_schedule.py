@@ -1,43 +1,318 @@
-from datetime import timedelta
+import os
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from functools import partial
 
-from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.events import EVENT_JOB_MAX_INSTANCES, EVENT_JOB_MISSED
+from apscheduler.jobstores.memory import MemoryJobStore
+from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.date import DateTrigger
 
-from beat81.beat81_api import register_recursive, find_next_event, ticket_book
+from beat81.beat81_api import register_event, day_events, find_event_at, ticket_book, event_info, events_cache, \
+    ticket_cache, read_flights, circuit_breaker, rate_limiter, priority_gate, invalidate_events_cache
+from beat81.beat81_async_api import read_flights as async_read_flights
 from beat81.city_helper import City
-from beat81.date_helper import DaysOfWeek, next_date_time_weekday
-from beat81.db_helper import get_all_subscriptions, get_all_auto_joins, cancel_auto_join
+from beat81.date_helper import DaysOfWeek, next_date_to_day, get_date_time_utc, get_timestamp_from_string, \
+    get_date_from_string
+from beat81.db_helper import DATA_DIRECTORY, get_active_subscriptions, get_due_auto_joins, cancel_auto_join, \
+    update_auto_join_checks, retire_past_auto_joins, queue_relogin_notices, user_cache, get_subscription_by_id, \
+    get_user_by_user_id, is_token_valid
+from beat81.lease_helper import leased_shards, ShardLease, JOB_SHARDS
+from beat81.priority_helper import Priority, request_priority
+
+AUTO_JOIN_WORKERS = int(os.getenv("AUTO_JOIN_WORKERS", 16))
+AUTO_JOIN_SLOT_SECONDS = 60
+AUTO_JOIN_MIN_INTERVAL = 60
+AUTO_JOIN_MAX_INTERVAL = 4 * 60 * 60
+# How long before a class it becomes bookable, subscription slots are registered the moment it opens
+BOOKING_WINDOW = timedelta(hours=float(os.getenv("BOOKING_WINDOW_HOURS", 21 * 24)))
+# Slots opening before the next subscription_job run, with some slack, get a one-shot job
+BOOKING_PLAN_HORIZON = timedelta(hours=26)
+BOOKING_PREFETCH_SECONDS = int(os.getenv("BOOKING_PREFETCH_SECONDS", 10))
+BOOKING_SLOT_GRACE_SECONDS = 10 * 60
+# Only the bot keeps its jobs on disk, a job store is never shared between processes
+BOT_JOB_STORE_FILE = os.path.join(DATA_DIRECTORY, "bot_jobs.db")
+
+scheduler = None
 
 
 def subscription_job():
     print("Running job to register all subscriptions....")
-    subscriptions = get_all_subscriptions()
-    for subscription in subscriptions:
+    queue_expired_token_notices()
+    plan_subscription_slots()
+    for lease in leased_shards("subscription_job", time.strftime("%Y-%m-%d")):
+        # Read after the lease is held, so rows are never planned by two workers
+        subscriptions = get_active_subscriptions(shard=lease.shard, shards=JOB_SHARDS) or []
+        register_subscriptions(lease, subscriptions)
+
+
+def plan_subscription_slots():
+    # Slots opening before the next run get a one-shot job in every process, the jobs are kept in memory
+    # so they are planned again on every start. The slot lease lets only one process register the slot.
+    now = datetime.now(timezone.utc)
+    for subscription in get_active_subscriptions() or []:
+        for date in subscription_dates(subscription, now + BOOKING_WINDOW + BOOKING_PLAN_HORIZON):
+            if booking_open_time(date) > now:
+                schedule_subscription_slot(subscription, date)
+
+
+def register_subscriptions(lease, subscriptions):
+    # Slots already bookable are registered right away, the later ones are left to their one-shot jobs
+    now = datetime.now(timezone.utc)
+    slots = [(subscription, date) for subscription in subscriptions
+             for date in subscription_dates(subscription, now + BOOKING_WINDOW)]
+
+    # Plan all slots first so subscriptions sharing a city and day share one events query
+    windows = {(City[subscription.get('city')], date.date()) for subscription, date in slots}
+    with request_priority(Priority.BULK):
+        events_by_window = {window: day_events(*window) for window in windows}
+    print(f"Fetched {len(windows)} city/day windows for {len(slots)} subscription slots of shard {lease.shard}")
+
+    for subscription, date in slots:
         telegram_user_id = subscription.get('telegram_user_id')
         location_id = subscription.get('location_id')
         city = City[subscription.get('city')]
-        day_of_week = DaysOfWeek[subscription.get('day_of_week')]
-        time = subscription.get('time')
-        hour = time.split(":")[0]
-        minute = time.split(":")[1]
-        date = next_date_time_weekday(day_of_week, int(hour), int(minute)) + timedelta(days=7)
-        next_event = find_next_event(city, location_id, date)
-        register_recursive(next_event.get('id'), telegram_user_id, city, location_id, date)
+        event = find_event_at(events_by_window[(city, date.date())], location_id, date)
+        if event is None:
+            print(f"No event found for subscription {subscription.get('id')} at {date}")
+            continue
+        if not lease.renew():
+            print(f"Lost the lease of subscription shard {lease.shard}, leaving it to the new owner")
+            return
+        with request_priority(Priority.BULK, telegram_user_id):
+            register_event(event.get('id'), telegram_user_id)
+
+
+def subscription_dates(subscription, last_date):
+    day_of_week = DaysOfWeek[subscription.get('day_of_week')]
+    hour, minute = (int(value) for value in subscription.get('time').split(":"))
+    day = next_date_to_day(day_of_week) + timedelta(days=7)
+    dates = [get_date_time_utc(day, hour, minute)]
+    while get_date_time_utc(day + timedelta(days=7), hour, minute) <= last_date:
+        day += timedelta(days=7)
+        dates.append(get_date_time_utc(day, hour, minute))
+    return dates
+
+
+def booking_open_time(date):
+    return date - BOOKING_WINDOW
+
+
+def schedule_subscription_slot(subscription, date):
+    # The listing is fetched a few seconds early, which also warms the pooled connection,
+    # so the registration at the opening second only needs the POST
+    open_time = booking_open_time(date)
+    slot_key = f"{subscription.get('id')}_{date:%Y%m%d%H%M}"
+    scheduler.add_job("beat81.job_schedule:prefetch_subscription_slot",
+                      DateTrigger(run_date=open_time - timedelta(seconds=BOOKING_PREFETCH_SECONDS)),
+                      args=[subscription.get('city'), date.isoformat()], id=f"subscription_prefetch_{slot_key}",
+                      replace_existing=True, misfire_grace_time=BOOKING_PREFETCH_SECONDS, jobstore="slots")
+    scheduler.add_job("beat81.job_schedule:book_subscription_slot", DateTrigger(run_date=open_time),
+                      args=[subscription.get('id'), date.isoformat()], id=f"subscription_slot_{slot_key}",
+                      replace_existing=True, misfire_grace_time=BOOKING_SLOT_GRACE_SECONDS, jobstore="slots")
+
+
+def prefetch_subscription_slot(city, iso_date):
+    date = get_date_from_string(iso_date)
+    with request_priority(Priority.AUTO_JOIN):
+        day_events(City[city], date.date())
+
+
+def book_subscription_slot(subscription_id, iso_date):
+    date = get_date_from_string(iso_date)
+    subscription = get_subscription_by_id(subscription_id)
+    if subscription is None:
+        return
+    telegram_user_id = subscription.get('telegram_user_id')
+    user = get_user_by_user_id(telegram_user_id)
+    if user is None or user.get('token') is None or not is_token_valid(user):
+        return
+    # Every process plans the job, only the lease holder registers
+    lease = ShardLease("subscription_slot", subscription_id, iso_date)
+    if not lease.acquire():
+        return
+
+    city = City[subscription.get('city')]
+    with request_priority(Priority.AUTO_JOIN, telegram_user_id):
+        event = find_event_at(day_events(city, date.date()), subscription.get('location_id'), date)
+        if event is None:
+            # The prefetched listing may predate the event's publication
+            invalidate_events_cache()
+            event = find_event_at(day_events(city, date.date()), subscription.get('location_id'), date)
+        if event is None:
+            print(f"No event found for subscription {subscription_id} at {date} when its booking opened")
+        else:
+            register_event(event.get('id'), telegram_user_id)
+    lease.complete()
 
 
 def auto_join_job():
-    auto_joins = get_all_auto_joins()
-    for auto_join in auto_joins:
-        telegram_user_id = auto_join.get('telegram_user_id')
-        ticket_id = auto_join.get('ticket_id')
-        result = ticket_book(telegram_user_id, ticket_id)
-        if result:
-            print(f"Auto join booked successfully for ticket id {auto_join.get('ticket_id')}")
+    start_time = time.monotonic()
+    now = int(time.time())
+    queue_expired_token_notices()
+    retired = retire_past_auto_joins(now)
+    if retired:
+        print(f"Retired {retired} auto joins of events that already started")
+    attempts = due_count = 0
+
+    with ThreadPoolExecutor(max_workers=AUTO_JOIN_WORKERS, thread_name_prefix="auto_join") as executor:
+        for lease in leased_shards("auto_join_job", time.strftime("%Y-%m-%dT%H:%M")):
+            auto_joins = get_due_auto_joins(now, lease.shard, JOB_SHARDS) or []
+
+            auto_joins_by_event = defaultdict(list)
+            for auto_join in auto_joins:
+                auto_joins_by_event[auto_join.get('event_id')].append(auto_join)
+            due_count += len(auto_joins)
+
+            # A user's attempts never run concurrently, even when they wait on several events
+            user_locks = {auto_join.get('telegram_user_id'): threading.Lock() for auto_join in auto_joins}
+            attempts += sum(executor.map(partial(book_event_auto_joins, lease, user_locks, now),
+                                         auto_joins_by_event.items()))
+
+    duration = time.monotonic() - start_time
+    rate = attempts / duration if duration else 0.0
+    print(f"Auto join job finished: {attempts} attempts for {due_count} due auto joins "
+          f"in {duration:.2f}s ({rate:.1f} attempts/s)")
+    if duration > AUTO_JOIN_SLOT_SECONDS / 2:
+        print(f"Auto join job used more than half of its {AUTO_JOIN_SLOT_SECONDS}s slot, "
+              f"consider raising AUTO_JOIN_WORKERS (currently {AUTO_JOIN_WORKERS})")
+
+
+def book_event_auto_joins(lease, user_locks, now, event_auto_joins):
+    event_id, auto_joins = event_auto_joins
+    with request_priority(Priority.AUTO_JOIN):
+        event = event_info(event_id)
+    if event is None:
+        # Unknown state, check again in the next run
+        update_auto_join_checks([(auto_join.get('id'), auto_join.get('event_start'), now + AUTO_JOIN_MIN_INTERVAL,
+                                  auto_join.get('attempts'), auto_join.get('last_participants_count'))
+                                 for auto_join in auto_joins])
+        return 0
+
+    event_data = event.get('data', {})
+    event_start = get_timestamp_from_string(event_data.get('date_begin'))
+    if event_start is not None and event_start <= now:
+        for auto_join in auto_joins:
             cancel_auto_join(auto_join.get('id'))
+        print(f"Retired {len(auto_joins)} auto joins of started event {event_id}")
+        return 0
+
+    max_participants = event_data.get('max_participants', 0)
+    participants_count = event_data.get('participants_count', 0)
+    free_spots = max_participants - participants_count
+    attempts = 0
+    checks = []
+    # Oldest auto joins get the free spots first
+    for auto_join in sorted(auto_joins, key=lambda row: row.get('id')):
+        failed = False
+        if free_spots > 0:
+            if not lease.renew():
+                print(f"Lost the lease of auto join shard {lease.shard}, leaving it to the new owner")
+                break
+            telegram_user_id = auto_join.get('telegram_user_id')
+            ticket_id = auto_join.get('ticket_id')
+            attempts += 1
+            try:
+                with user_locks[telegram_user_id], request_priority(Priority.AUTO_JOIN, telegram_user_id):
+                    result = ticket_book(telegram_user_id, ticket_id)
+            except Exception as e:
+                print(f"Error while auto joining ticket id {ticket_id}: {e}")
+                result = False
+            if result:
+                print(f"Auto join booked successfully for ticket id {ticket_id}")
+                cancel_auto_join(auto_join.get('id'))
+                free_spots -= 1
+                continue
+            failed = True
+
+        row_attempts = (auto_join.get('attempts') or 0) + failed
+        changed = auto_join.get('last_participants_count') not in (None, participants_count)
+        interval = auto_join_interval(event_start - now if event_start else 0, changed, row_attempts)
+        # Our own bookings of this run don't count as a change on the next check
+        checks.append((auto_join.get('id'), event_start, now + interval, row_attempts,
+                       max_participants - free_spots))
+    update_auto_join_checks(checks)
+    return attempts
+
+
+def auto_join_interval(seconds_until_start, participants_changed, attempts):
+    # Classes starting soon and classes whose participants just changed are checked every run.
+    # Classes further out are checked less often and back off after failed attempts,
+    # but never wait longer than a quarter of the time left.
+    if participants_changed or seconds_until_start <= 3 * 60 * 60:
+        return AUTO_JOIN_MIN_INTERVAL
+    if seconds_until_start <= 24 * 60 * 60:
+        interval = 5 * 60
+    elif seconds_until_start <= 3 * 24 * 60 * 60:
+        interval = 15 * 60
+    else:
+        interval = 60 * 60
+    interval = min(interval * 2 ** min(attempts, 3), AUTO_JOIN_MAX_INTERVAL, seconds_until_start // 4)
+    return max(interval, AUTO_JOIN_MIN_INTERVAL)
+
+
+def queue_expired_token_notices():
+    queued = queue_relogin_notices()
+    if queued:
+        print(f"Queued relogin notices for {queued} users with expired tokens")
+
+
+def log_stats_job():
+    for name, cache in (("Events", events_cache), ("Ticket", ticket_cache), ("User", user_cache)):
+        stats = cache.stats()
+        print(f"{name} cache: size {stats['size']}, hits {stats['hits']}, misses {stats['misses']}, "
+              f"evictions {stats['evictions']}, hit rate {stats['hit_rate']:.1%}")
+    print(f"Coalesced reads: {read_flights.shared} sync, {async_read_flights.shared} async")
+    breaker = circuit_breaker.stats()
+    print(f"Beat81 circuit breaker: {breaker['state']}, failures {breaker['failures']}, "
+          f"rejected {breaker['rejected']}, throttled per endpoint {rate_limiter.stats()}")
+    gate = priority_gate.stats()
+    print(f"Beat81 priority gate: in flight {gate['in_flight']}, queue depth {gate['queue_depth']}, "
+          f"queued {gate['queued']}, max wait {gate['max_wait']}")
+
+
+def log_skipped_run(event):
+    if event.code == EVENT_JOB_MAX_INSTANCES:
+        print(f"Job {event.job_id} skipped its run at {event.scheduled_run_times}, the previous run is still going")
+    else:
+        print(f"Job {event.job_id} missed its run at {event.scheduled_run_time}")
+
+
+def init_scheduler(durable=False):
+    # Runs on the process' event loop, the sync jobs themselves run in the loop's default executor.
+    # Every process schedules the jobs in its own store and the job leases split the work, APScheduler
+    # doesn't support several schedulers on one store. The bot's store is durable so a run missed during
+    # a restart still fires within its grace time, the workers keep their jobs in memory. The one-shot
+    # subscription slot jobs are always kept in memory and planned again below.
+    global scheduler
+    job_store = SQLAlchemyJobStore(url=f"sqlite:///{BOT_JOB_STORE_FILE}") if durable else MemoryJobStore()
+    scheduler = AsyncIOScheduler(
+        jobstores={"default": job_store, "slots": MemoryJobStore()},
+        job_defaults={"max_instances": 1, "coalesce": True})
+    scheduler.add_listener(log_skipped_run, EVENT_JOB_MAX_INSTANCES | EVENT_JOB_MISSED)
+    # Paused until the stored jobs are checked, otherwise a missed run could fire before being replaced
+    scheduler.start(paused=True)
+    schedule_job("subscription_job", CronTrigger(hour="21", minute="0", second="0"), 3 * 60 * 60)
+    schedule_job("auto_join_job", CronTrigger(minute="*/1", second="0"), AUTO_JOIN_SLOT_SECONDS // 2)
+    schedule_job("log_stats_job", CronTrigger(minute="*/10", second="30"), 60)
+    plan_subscription_slots()
+    scheduler.resume()
+
+
+def schedule_job(name, trigger, misfire_grace_time):
+    # A stored job keeps its next run time, so the run missed while the bot was down is caught up.
+    # It is only replaced when its schedule changed.
+    job = scheduler.get_job(name)
+    if job is None or str(job.trigger) != str(trigger) or job.misfire_grace_time != misfire_grace_time:
+        scheduler.add_job(f"beat81.job_schedule:{name}", trigger, id=name, replace_existing=True,
+                          misfire_grace_time=misfire_grace_time)
 
 
-def init_scheduler():
-    scheduler = BackgroundScheduler()
-    scheduler.add_job(subscription_job, CronTrigger(hour="21", minute="0", second="0"))
-    scheduler.add_job(auto_join_job, CronTrigger(minute="*/1", second="0"))
-    scheduler.start()
+def shutdown_scheduler():
+    if scheduler is not None and scheduler.running:
+        scheduler.shutdown(wait=False)
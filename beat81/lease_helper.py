@@ -0,0 +1,46 @@
+import os
+import random
+import socket
+
+from beat81.db_helper import acquire_lease, renew_lease, complete_lease
+
+JOB_SHARDS = int(os.getenv("JOB_SHARDS", 8))
+JOB_LEASE_SECONDS = int(os.getenv("JOB_LEASE_SECONDS", 120))
+# Unique per worker process, also across containers sharing the data volume
+WORKER_ID = os.getenv("WORKER_ID") or f"{socket.gethostname()}-{os.getpid()}"
+
+
+def shard_of(telegram_user_id):
+    # All rows of a user land in the same shard, so one worker handles all of that user's bookings.
+    # Matches the shard filter of the SQL queries.
+    return abs(int(telegram_user_id)) % JOB_SHARDS
+
+
+class ShardLease:
+
+    def __init__(self, job, shard, run):
+        self.job = job
+        self.shard = shard
+        self.run = run
+
+    def acquire(self):
+        return acquire_lease(self.job, self.shard, WORKER_ID, self.run, JOB_LEASE_SECONDS)
+
+    def renew(self):
+        # False once another worker took the expired lease over, the shard must not be touched anymore
+        return renew_lease(self.job, self.shard, WORKER_ID, JOB_LEASE_SECONDS)
+
+    def complete(self):
+        complete_lease(self.job, self.shard, WORKER_ID, self.run)
+
+
+def leased_shards(job, run):
+    # Yields the shards of this run no other worker holds or completed, in random order so workers
+    # starting together spread over the shards. A shard is completed once the caller asks for the next one,
+    # a shard whose processing failed stays leased until it expires and another worker takes it over.
+    for shard in random.sample(range(JOB_SHARDS), JOB_SHARDS):
+        lease = ShardLease(job, shard, run)
+        if not lease.acquire():
+            continue
+        yield lease
+        lease.complete()
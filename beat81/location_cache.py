@@ -0,0 +1,41 @@
+import os
+from datetime import datetime, timedelta
+
+from beat81.cache_helper import TTLCache
+from beat81.db_helper import get_locations, save_location
+
+LOCATION_TTL = timedelta(hours=float(os.getenv("LOCATION_CACHE_TTL_HOURS", 24 * 7)))
+LOCATION_CACHE_SIZE = int(os.getenv("LOCATION_CACHE_SIZE", 512))
+
+# In-memory LRU in front of the locations table
+memory_cache = TTLCache(maxsize=LOCATION_CACHE_SIZE, ttl=LOCATION_TTL.total_seconds())
+
+
+def get_cached_locations(location_ids):
+    found = {}
+    missing = []
+    for location_id in dict.fromkeys(location_ids):
+        location_data = memory_cache.get(location_id)
+        if location_data is None:
+            missing.append(location_id)
+        else:
+            found[location_id] = location_data
+
+    if missing:
+        stored = get_locations(missing, datetime.now() - LOCATION_TTL)
+        for location_id, location_data in stored.items():
+            memory_cache.set(location_id, location_data)
+        found.update(stored)
+        missing = [location_id for location_id in missing if location_id not in stored]
+
+    return found, missing
+
+
+def get_cached_location(location_id):
+    found, _ = get_cached_locations([location_id])
+    return found.get(location_id)
+
+
+def cache_location(location_id, location_data):
+    memory_cache.set(location_id, location_data)
+    save_location(location_id, location_data)
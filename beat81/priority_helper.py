@@ -0,0 +1,152 @@
+import asyncio
+import contextvars
+import threading
+import time
+from collections import OrderedDict, deque, Counter
+from contextlib import contextmanager, asynccontextmanager
+from enum import IntEnum
+
+
+class Priority(IntEnum):
+    INTERACTIVE = 0
+    AUTO_JOIN = 1
+    BULK = 2
+
+
+# Set by the callers, read by the gate when an outbound request waits for a slot
+current_priority = contextvars.ContextVar("current_priority", default=Priority.INTERACTIVE)
+current_user = contextvars.ContextVar("current_user", default=None)
+
+
+@contextmanager
+def request_priority(priority, user=None):
+    priority_token = current_priority.set(priority)
+    user_token = current_user.set(user)
+    try:
+        yield
+    finally:
+        current_priority.reset(priority_token)
+        current_user.reset(user_token)
+
+
+class Waiter:
+
+    def __init__(self, priority, user, wake):
+        self.priority = priority
+        self.user = user
+        self.wake = wake
+        self.enqueued_at = time.monotonic()
+
+
+class PriorityGate:
+    """Bounds the outbound requests in flight and hands free slots to the highest priority class first,
+    round-robin across users within a class. Background classes never use the slots reserved for
+    interactive requests. Works for threads and coroutines alike."""
+
+    def __init__(self, max_in_flight, reserved_interactive):
+        self.max_in_flight = max_in_flight
+        self.reserved_interactive = reserved_interactive
+        self.in_flight = 0
+        # Per priority class: user -> queued waiters of that user
+        self.queues = {priority: OrderedDict() for priority in Priority}
+        self.lock = threading.Lock()
+        self.granted = Counter()
+        self.queued = Counter()
+        self.max_wait = Counter()
+
+    def capacity(self, priority):
+        if priority == Priority.INTERACTIVE:
+            return self.max_in_flight
+        return self.max_in_flight - self.reserved_interactive
+
+    def enter(self, waiter):
+        with self.lock:
+            waiting_ahead = any(self.queues[priority] for priority in Priority if priority <= waiter.priority)
+            if not waiting_ahead and self.in_flight < self.capacity(waiter.priority):
+                self.in_flight += 1
+                self.granted[waiter.priority.name] += 1
+                return True
+            self.queues[waiter.priority].setdefault(waiter.user, deque()).append(waiter)
+            self.queued[waiter.priority.name] += 1
+            return False
+
+    def release(self):
+        with self.lock:
+            self.in_flight -= 1
+            waiter = self.next_waiter()
+        if waiter is not None:
+            waiter.wake()
+
+    def next_waiter(self):
+        for priority in Priority:
+            users = self.queues[priority]
+            if not users:
+                continue
+            if self.in_flight >= self.capacity(priority):
+                return None
+            user, waiters = next(iter(users.items()))
+            waiter = waiters.popleft()
+            if waiters:
+                users.move_to_end(user)
+            else:
+                del users[user]
+            self.in_flight += 1
+            self.granted[priority.name] += 1
+            wait = time.monotonic() - waiter.enqueued_at
+            self.max_wait[priority.name] = max(self.max_wait[priority.name], wait)
+            return waiter
+        return None
+
+    def cancel(self, waiter):
+        with self.lock:
+            waiters = self.queues[waiter.priority].get(waiter.user)
+            if waiters is None or waiter not in waiters:
+                return False
+            waiters.remove(waiter)
+            if not waiters:
+                del self.queues[waiter.priority][waiter.user]
+            return True
+
+    @contextmanager
+    def slot(self):
+        granted = threading.Event()
+        waiter = Waiter(current_priority.get(), current_user.get(), granted.set)
+        if not self.enter(waiter):
+            granted.wait()
+        try:
+            yield
+        finally:
+            self.release()
+
+    @asynccontextmanager
+    async def async_slot(self):
+        loop = asyncio.get_running_loop()
+        granted = loop.create_future()
+
+        def wake():
+            loop.call_soon_threadsafe(lambda: granted.done() or granted.set_result(None))
+
+        waiter = Waiter(current_priority.get(), current_user.get(), wake)
+        if not self.enter(waiter):
+            try:
+                await granted
+            except asyncio.CancelledError:
+                # Already granted when the cancel raced the wake-up, hand the slot on
+                if not self.cancel(waiter):
+                    self.release()
+                raise
+        try:
+            yield
+        finally:
+            self.release()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "in_flight": self.in_flight,
+                "queue_depth": {priority.name: sum(len(waiters) for waiters in self.queues[priority].values())
+                                for priority in Priority},
+                "granted": dict(self.granted),
+                "queued": dict(self.queued),
+                "max_wait": {name: round(wait, 3) for name, wait in self.max_wait.items()}
+            }
@@ -0,0 +1,133 @@
+import asyncio
+import threading
+import time
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling the upstream while the circuit breaker is open."""
+    pass
+
+
+class TokenBucket:
+    """Thread-safe token bucket, callers reserve a token and sleep for the returned delay."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+        self.throttled = 0
+
+    def reserve(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0.0
+            self.throttled += 1
+            return -self.tokens / self.rate
+
+
+class RateLimiter:
+    """A global token bucket plus optional per-endpoint buckets, usable from threads and coroutines."""
+
+    def __init__(self, rate, capacity, endpoint_budgets):
+        self.global_bucket = TokenBucket(rate, capacity)
+        self.buckets = {endpoint: TokenBucket(*budget) for endpoint, budget in endpoint_budgets.items()}
+
+    def reserve(self, endpoint):
+        delay = self.global_bucket.reserve()
+        bucket = self.buckets.get(endpoint)
+        if bucket is not None:
+            delay = max(delay, bucket.reserve())
+        return delay
+
+    def acquire(self, endpoint):
+        delay = self.reserve(endpoint)
+        if delay > 0:
+            time.sleep(delay)
+
+    async def acquire_async(self, endpoint):
+        delay = self.reserve(endpoint)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def stats(self):
+        throttled = {endpoint: bucket.throttled for endpoint, bucket in self.buckets.items()}
+        throttled["global"] = self.global_bucket.throttled
+        return throttled
+
+
+class CircuitBreaker:
+    """Opens after consecutive upstream failures and lets a single trial call through once the
+    back-off has passed. Every failed trial doubles the back-off up to max_reset_timeout."""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold, reset_timeout, max_reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.base_reset_timeout = reset_timeout
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_until = 0.0
+        self.trial_in_flight = False
+        self.rejected = 0
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.state == self.OPEN and time.monotonic() >= self.opened_until:
+                self.state = self.HALF_OPEN
+                self.trial_in_flight = False
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.HALF_OPEN and not self.trial_in_flight:
+                self.trial_in_flight = True
+                return True
+            self.rejected += 1
+            return False
+
+    def record_success(self):
+        with self.lock:
+            if self.state != self.CLOSED:
+                print("Circuit breaker closed, upstream is healthy again")
+            self.state = self.CLOSED
+            self.failures = 0
+            self.reset_timeout = self.base_reset_timeout
+            self.trial_in_flight = False
+
+    def release_trial(self):
+        # The allowed call ended without an upstream result, e.g. it was cancelled while queued,
+        # so the next call may be the trial instead
+        with self.lock:
+            if self.state == self.HALF_OPEN:
+                self.trial_in_flight = False
+
+    def record_failure(self, retry_after=None):
+        with self.lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN:
+                self.reset_timeout = min(self.reset_timeout * 2, self.max_reset_timeout)
+            elif self.failures < self.failure_threshold and retry_after is None:
+                return
+            timeout = max(self.reset_timeout, retry_after or 0)
+            self.state = self.OPEN
+            self.opened_until = time.monotonic() + timeout
+            self.trial_in_flight = False
+            print(f"Circuit breaker open for {timeout:.0f}s after {self.failures} failures")
+
+    def stats(self):
+        with self.lock:
+            return {
+                "state": self.state,
+                "failures": self.failures,
+                "rejected": self.rejected,
+                "reset_timeout": self.reset_timeout
+            }
@@ -2,20 +2,39 @@ import os
 
 from dotenv import load_dotenv
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import TelegramError
 from telegram.ext import CommandHandler, CallbackQueryHandler, MessageHandler, Application, ContextTypes, filters
 
-from beat81.beat81_api import login, tickets, ticket_info, ticket_cancel, UnauthorizedException, events, event_info, \
-    register_event, register_series, location_info
+from beat81.async_db_helper import get_user_by_user_id, clear_token, get_user_subscriptions, \
+    get_subscription_by_id, cancel_subscription, save_auto_join, get_user_auto_joins, get_auto_join_by_id, \
+    cancel_auto_join, get_auto_join_by_event_id, delete_auto_join_by_ticket_id, get_pending_relogin_notices, \
+    mark_relogin_notice_sent, shutdown_db_thread
+from beat81.beat81_api import UnauthorizedException, IncompletePagesException
+from beat81.beat81_async_api import login, user_tickets, user_ticket, ticket_cancel, events, event_info, \
+    register_event, register_series, location_info, locations_info, close_client
 from beat81.city_helper import City
-from beat81.date_helper import get_date_formatted_day_hour, DaysOfWeek, get_date_formatted_hour, get_weekday_form_date
-from beat81.db_helper import get_user_by_user_id, clear_token, get_user_subscriptions, get_subscription_by_id, \
-    cancel_subscription, save_auto_join, get_user_auto_joins, get_auto_join_by_id, cancel_auto_join, \
-    get_auto_join_by_event_id, delete_auto_join_by_ticket_id
-from beat81.job_schedule import init_scheduler
+from beat81.date_helper import get_date_formatted_day_hour, DaysOfWeek, get_date_formatted_hour, get_weekday_form_date, \
+    get_timestamp_from_string
+from beat81.db_helper import is_token_valid
+from beat81.job_schedule import init_scheduler, shutdown_scheduler
+from beat81.priority_helper import current_user
+from beat81.update_processor_helper import PerUserUpdateProcessor
 
 # Load token and other environment variables from .env file
 load_dotenv()
 BOT_TOKEN = os.getenv("TG_TOKEN")  # This should match the key in your .env file
+# "polling" or "webhook", a webhook needs the public TG_WEBHOOK_URL Telegram posts the updates to
+BOT_MODE = os.getenv("TG_MODE", "polling")
+WEBHOOK_URL = os.getenv("TG_WEBHOOK_URL")
+WEBHOOK_LISTEN = os.getenv("TG_WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("TG_WEBHOOK_PORT", 8443))
+WEBHOOK_PATH = os.getenv("TG_WEBHOOK_PATH", "telegram")
+WEBHOOK_SECRET = os.getenv("TG_WEBHOOK_SECRET")
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("TG_MAX_CONNECTIONS", 40))
+# Updates of different users are handled concurrently, the updates of one user in order
+MAX_CONCURRENT_UPDATES = int(os.getenv("TG_CONCURRENT_UPDATES", 32))
+# Points the bot at another Bot API server, e.g. a local fake Telegram server in tests
+BOT_API_URL = os.getenv("TG_BASE_URL")
 
 # Dictionary to hold user data temporarily
 user_data = {}
@@ -23,7 +42,7 @@ user_data = {}
 
 # Start command: Show a menu with options (like the Login button)
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text("Main menu", reply_markup=main_menu_keyboard(update.effective_user.id))
+    await update.message.reply_text("Main menu", reply_markup=await main_menu_keyboard(update.effective_user.id))
 
 
 # Callback for handling button clicks
@@ -32,9 +51,11 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.answer()  # Answer the callback query
 
     telegram_user_id = query.from_user.id
+    # Outbound requests are queued fairly per user when the API slots are busy
+    current_user.set(telegram_user_id)
 
     if query.data == "main_menu":
-        await query.message.reply_text("Main menu", reply_markup=main_menu_keyboard(telegram_user_id))
+        await query.message.reply_text("Main menu", reply_markup=await main_menu_keyboard(telegram_user_id))
 
     if query.data == "login":
         # Start the login process by asking for the email
@@ -52,9 +73,9 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     elif query.data.startswith("subscriptionInfo_"):
         subscription_id = query.data.split("_")[1]
-        subscription_data = get_subscription_by_id(subscription_id)
+        subscription_data = await get_subscription_by_id(subscription_id)
         location_id = subscription_data.get('location_id')
-        location_data = location_info(location_id).get('data')
+        location_data = (await location_info(location_id)).get('data')
         location_name = location_data.get('name')
         time = subscription_data.get('time')
         day_of_week = subscription_data.get('day_of_week')
@@ -67,9 +88,11 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     elif query.data.startswith("autoJoinInfo_"):
         auto_join_id = query.data.split("_")[1]
-        auto_join_data = get_auto_join_by_id(auto_join_id)
+        auto_join_data = await get_auto_join_by_id(auto_join_id)
         ticket_id = auto_join_data.get('ticket_id')
-        ticket_data = ticket_info(telegram_user_id, ticket_id).get('data')
+        ticket_data = await load_ticket(query, telegram_user_id, ticket_id)
+        if ticket_data is None:
+            return
         event = ticket_data.get('event')
         iso_date = event.get('date_begin')
         formatted_time = get_date_formatted_day_hour(iso_date)
@@ -86,7 +109,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     elif query.data.startswith("cancelAutoJoin_"):
         auto_join_id = query.data.split("_")[1]
-        result = cancel_auto_join(auto_join_id)
+        result = await cancel_auto_join(auto_join_id)
         if result:
             await query.message.reply_text("Auto join cancelled successfully")
         else:
@@ -95,7 +118,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     elif query.data.startswith("cancelSubscription_"):
         subscription_id = query.data.split("_")[1]
-        result = cancel_subscription(subscription_id)
+        result = await cancel_subscription(subscription_id)
         if result:
             await query.message.reply_text("Subscription cancelled successfully")
         else:
@@ -105,8 +128,8 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     elif query.data.startswith("cancelTicket_"):
         ticket_id = query.data.split("_")[1]
-        result = ticket_cancel(telegram_user_id, ticket_id)
-        delete_auto_join_by_ticket_id(ticket_id)
+        result = await ticket_cancel(telegram_user_id, ticket_id)
+        await delete_auto_join_by_ticket_id(ticket_id)
         if result:
             await query.message.reply_text("Ticket cancelled successfully")
         else:
@@ -115,7 +138,9 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     elif query.data.startswith("ticketInfo_"):
         ticket_id = query.data.split("_")[1]
-        ticket_data = ticket_info(telegram_user_id, ticket_id).get('data')
+        ticket_data = await load_ticket(query, telegram_user_id, ticket_id)
+        if ticket_data is None:
+            return
         event = ticket_data.get('event')
         event_id = event.get('id')
         current_status = ticket_data.get('current_status')
@@ -131,7 +156,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         keyboard = []
         if status_name == 'waitlisted':
             keyboard.append([InlineKeyboardButton("Leave waitlist", callback_data=f"cancelTicket_{ticket_id}")])
-            auto_join_result = get_auto_join_by_event_id(event_id)
+            auto_join_result = await get_auto_join_by_event_id(event_id)
             if auto_join_result is None:
                 keyboard.append(
                     [InlineKeyboardButton("Auto join", callback_data=f"autoJoin_{ticket_id}"), ])
@@ -146,7 +171,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     elif query.data.startswith("eventInfo_"):
         event_id = query.data.split("_")[1]
-        event = event_info(event_id).get('data')
+        event = (await event_info(event_id)).get('data')
         iso_date = event.get('date_begin')
         formatted_time = get_date_formatted_day_hour(iso_date)
         location = event.get('location')
@@ -165,40 +190,50 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     elif query.data.startswith("registerEventOnce_"):
         event_id = query.data.split("_")[1]
-        register_data = register_event(event_id, telegram_user_id).get('data')
+        register_data = (await register_event(event_id, telegram_user_id)).get('data')
         current_status = register_data.get('current_status').get('status_name')
         if current_status == 'booked':
             await query.message.reply_text("Session booked successfully",
-                                           reply_markup=main_menu_keyboard(telegram_user_id))
+                                           reply_markup=await main_menu_keyboard(telegram_user_id))
         elif current_status == 'waitlisted':
             await query.message.reply_text("Joined waitlist successfully.",
-                                           reply_markup=main_menu_keyboard(telegram_user_id))
+                                           reply_markup=await main_menu_keyboard(telegram_user_id))
         else:
             await query.message.reply_text("Something went wrong. Please try again later.",
-                                           reply_markup=main_menu_keyboard(telegram_user_id))
+                                           reply_markup=await main_menu_keyboard(telegram_user_id))
 
     elif query.data.startswith("registerEventSeries_"):
         event_id = query.data.split("_")[1]
-        register_series(event_id, telegram_user_id)
-        await query.message.reply_text("Series booked successfully", reply_markup=main_menu_keyboard(telegram_user_id))
+        booked, series_size, listed = await register_series(event_id, telegram_user_id)
+        if listed and booked == series_size:
+            message = "Series booked successfully"
+        elif listed or not booked:
+            message = f"Only {booked} of {series_size} classes of the series could be booked."
+        else:
+            message = ("Could not load the upcoming classes, only this class was booked. "
+                       "Your subscription will book the next ones.")
+        await query.message.reply_text(message, reply_markup=await main_menu_keyboard(telegram_user_id))
 
     elif query.data.startswith("autoJoin_"):
         ticket_id = query.data.split("_")[1]
-        ticket_data = ticket_info(telegram_user_id, ticket_id).get('data')
-        result = save_auto_join(telegram_user_id, ticket_id, ticket_data.get('event_id'))
+        ticket_data = await load_ticket(query, telegram_user_id, ticket_id)
+        if ticket_data is None:
+            return
+        event_start = get_timestamp_from_string((ticket_data.get('event') or {}).get('date_begin'))
+        result = await save_auto_join(telegram_user_id, ticket_id, ticket_data.get('event_id'), event_start)
         if result:
             await query.message.reply_text("Auto join saved successfully.",
-                                           reply_markup=main_menu_keyboard(telegram_user_id))
+                                           reply_markup=await main_menu_keyboard(telegram_user_id))
         else:
             await query.message.reply_text("Something went wrong. Please try again later.",
-                                           reply_markup=main_menu_keyboard(telegram_user_id))
+                                           reply_markup=await main_menu_keyboard(telegram_user_id))
 
 
     elif query.data.startswith("changeCity_"):
         city = City[query.data.split("_")[1]]
-        user_data[telegram_user_id]['current_city'] = city
+        user_data.setdefault(telegram_user_id, {})['current_city'] = city
         await query.message.reply_text(f"changed city to {city.value}")
-        await query.message.reply_text("Main menu", reply_markup=main_menu_keyboard(telegram_user_id))
+        await query.message.reply_text("Main menu", reply_markup=await main_menu_keyboard(telegram_user_id))
 
     elif query.data == "changeCity":
         buttons = [
@@ -218,7 +253,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     elif query.data in [day.name for day in DaysOfWeek]:
         day = DaysOfWeek[query.data]
-        all_events = events(await get_user_city(telegram_user_id), day)
+        all_events = await events(await get_user_city(telegram_user_id), day)
         all_events_data = all_events.get('data')
         keyboard = []
         keyboard_row = []
@@ -247,16 +282,37 @@ async def get_user_city(telegram_user_id):
     return user_data.get(telegram_user_id, {}).get('current_city') or City.munich
 
 
+async def ask_to_login_again(query, telegram_user_id):
+    await clear_token(telegram_user_id)
+    await query.message.reply_text("Please login again.")
+    await query.message.reply_text("Main menu", reply_markup=await main_menu_keyboard(telegram_user_id))
+
+
+# The ticket, or None after telling the user why it could not be loaded
+async def load_ticket(query, telegram_user_id, ticket_id):
+    try:
+        ticket_data = await user_ticket(telegram_user_id, ticket_id)
+    except UnauthorizedException:
+        await ask_to_login_again(query, telegram_user_id)
+        return None
+    if ticket_data is None:
+        await query.message.reply_text("Could not load the ticket. Please try again later.",
+                                       reply_markup=await main_menu_keyboard(telegram_user_id))
+    return ticket_data
+
+
 async def get_my_bookings(query, telegram_user_id):
     try:
-        tickets_response = tickets(telegram_user_id)
+        tickets = list((await user_tickets(telegram_user_id)).values())
     except UnauthorizedException:
-        clear_token(telegram_user_id)
-        await query.message.reply_text("Please login again.")
-        await query.message.reply_text("Main menu", reply_markup=main_menu_keyboard(telegram_user_id))
+        await ask_to_login_again(query, telegram_user_id)
+        return
+    except IncompletePagesException:
+        await query.message.reply_text("Could not load your bookings. Please try again later.",
+                                       reply_markup=await main_menu_keyboard(telegram_user_id))
         return
     keyboard = []
-    for ticket in tickets_response.get('data', []):
+    for ticket in tickets:
         event = ticket.get('event')
         current_status = ticket.get('current_status')
         status_name = '(Waitlisted)' if current_status.get('status_name') == 'waitlisted' else ''
@@ -269,18 +325,20 @@ async def get_my_bookings(query, telegram_user_id):
             [InlineKeyboardButton(f"{location_name} - {formatted_time}{status_name}",
                                   callback_data=f"ticketInfo_{ticket_id}")])
     keyboard.append([InlineKeyboardButton("Back", callback_data="main_menu")])
-    await query.message.reply_text(f"Total bookings: {tickets_response.get('total')}",
+    await query.message.reply_text(f"Total bookings: {len(tickets)}",
                                    reply_markup=InlineKeyboardMarkup(keyboard))
 
 
 async def get_my_subscriptions(query, telegram_user_id):
-    subscriptions = get_user_subscriptions(telegram_user_id)
+    subscriptions = await get_user_subscriptions(telegram_user_id)
+    locations = await locations_info(subscription.get('location_id') for subscription in subscriptions)
     keyboard = []
     for subscription in subscriptions:
         subscription_id = subscription.get('id')
         location_id = subscription.get('location_id')
-        location_data = location_info(location_id).get('data')
-        location_name = location_data.get('name')
+        # A failed location lookup still lists the subscription
+        location_data = (locations.get(location_id) or {}).get('data') or {}
+        location_name = location_data.get('name', "Unknown location")
         time = subscription.get('time')
         day_of_week = subscription.get('day_of_week')
         keyboard.append(
@@ -292,20 +350,22 @@ async def get_my_subscriptions(query, telegram_user_id):
 
 
 async def get_my_auto_joins(query, telegram_user_id):
-    auto_joins = get_user_auto_joins(telegram_user_id)
+    auto_joins = await get_user_auto_joins(telegram_user_id)
     keyboard = []
     for auto_join in auto_joins:
         auto_join_id = auto_join.get('id')
         ticket_id = auto_join.get('ticket_id')
-        ticket_data = ticket_info(telegram_user_id, ticket_id).get('data')
-        event = ticket_data.get('event')
-        iso_date = event.get('date_begin')
-        formatted_time = get_date_formatted_day_hour(iso_date)
-        location = event.get('location')
-        location_name = location.get('name')
-        keyboard.append(
-            [InlineKeyboardButton(f"{location_name} - {formatted_time}",
-                                  callback_data=f"autoJoinInfo_{auto_join_id}")])
+        try:
+            ticket_data = await user_ticket(telegram_user_id, ticket_id)
+        except UnauthorizedException:
+            await ask_to_login_again(query, telegram_user_id)
+            return
+        if ticket_data is None:
+            label = "Unknown class"
+        else:
+            event = ticket_data.get('event')
+            label = f"{event.get('location').get('name')} - {get_date_formatted_day_hour(event.get('date_begin'))}"
+        keyboard.append([InlineKeyboardButton(label, callback_data=f"autoJoinInfo_{auto_join_id}")])
     keyboard.append([InlineKeyboardButton("Back", callback_data="main_menu")])
     await query.message.reply_text(f"Total auto joins: {len(auto_joins)}",
                                    reply_markup=InlineKeyboardMarkup(keyboard))
@@ -314,6 +374,7 @@ async def get_my_auto_joins(query, telegram_user_id):
 # Message handler for email and password input
 async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     telegram_user_id = update.effective_user.id
+    current_user.set(telegram_user_id)
 
     # Check if the user is in the middle of the login process
     if telegram_user_id in user_data:
@@ -333,11 +394,11 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             password = user_data[telegram_user_id]["password"]
 
             # Call the login API
-            login_success = login(telegram_user_id, email, password)
+            login_success = await login(telegram_user_id, email, password)
 
             if login_success:
                 await update.message.reply_text("Login successful! 🎉")
-                await update.message.reply_text("Main menu", reply_markup=main_menu_keyboard(telegram_user_id))
+                await update.message.reply_text("Main menu", reply_markup=await main_menu_keyboard(telegram_user_id))
             else:
                 await update.message.reply_text("Login failed. Please try again.")
 
@@ -348,9 +409,9 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Please click on the Login button to start the process.")
 
 
-def main_menu_keyboard(telegram_user_id):
-    user = get_user_by_user_id(telegram_user_id)
-    if user and user.get('token'):
+async def main_menu_keyboard(telegram_user_id):
+    user = await get_user_by_user_id(telegram_user_id)
+    if is_token_valid(user):
         if telegram_user_id not in user_data:
             user_data[telegram_user_id] = {}
         if 'current_city' not in user_data[telegram_user_id]:
@@ -366,6 +427,59 @@ def main_menu_keyboard(telegram_user_id):
     return InlineKeyboardMarkup(keyboard)
 
 
+# Sends the notices queued by the jobs for users whose Beat81 token expired
+async def send_relogin_notices(context: ContextTypes.DEFAULT_TYPE):
+    for telegram_user_id in await get_pending_relogin_notices():
+        try:
+            await context.bot.send_message(chat_id=telegram_user_id,
+                                           text="Your Beat81 login has expired. Please login again to keep your "
+                                                "subscriptions and auto joins running.",
+                                           reply_markup=await main_menu_keyboard(telegram_user_id))
+        except TelegramError as e:
+            print(f"Could not send relogin notice to {telegram_user_id}: {e}")
+        await mark_relogin_notice_sent(telegram_user_id)
+
+
+async def post_init(application: Application):
+    init_scheduler(durable=True)
+
+
+async def shutdown(application: Application):
+    shutdown_scheduler()
+    await close_client()
+    shutdown_db_thread()
+
+
+def build_application():
+    builder = Application.builder().token(BOT_TOKEN).post_init(post_init).post_shutdown(shutdown) \
+        .concurrent_updates(PerUserUpdateProcessor(MAX_CONCURRENT_UPDATES))
+    if BOT_API_URL:
+        builder = builder.base_url(BOT_API_URL + "/bot").base_file_url(BOT_API_URL + "/file/bot")
+    return builder.build()
+
+
+def run_application(application):
+    if BOT_MODE == "webhook":
+        if not WEBHOOK_URL:
+            print("Error: TG_WEBHOOK_URL is required in webhook mode!")
+            exit(1)
+        if not WEBHOOK_SECRET:
+            print("Error: TG_WEBHOOK_SECRET is required in webhook mode!")
+            exit(1)
+        # Telegram sends the secret in every request, requests without it are rejected by the listener
+        application.run_webhook(listen=WEBHOOK_LISTEN,
+                                port=WEBHOOK_PORT,
+                                url_path=WEBHOOK_PATH,
+                                webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+                                secret_token=WEBHOOK_SECRET,
+                                max_connections=WEBHOOK_MAX_CONNECTIONS)
+    elif BOT_MODE == "polling":
+        application.run_polling()
+    else:
+        print(f"Error: Unknown TG_MODE {BOT_MODE}, expected polling or webhook!")
+        exit(1)
+
+
 # Main function to run the bot
 if __name__ == "__main__":
     # Ensure the bot token was loaded correctly
@@ -374,13 +488,13 @@ if __name__ == "__main__":
         exit(1)
 
     # Build the application
-    application = Application.builder().token(BOT_TOKEN).build()
+    application = build_application()
 
     # Add Command and Callback handlers
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CallbackQueryHandler(button_handler))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, message_handler))
-    init_scheduler()
+    application.job_queue.run_repeating(send_relogin_notices, interval=60, first=10)
 
     # Start the bot
-    application.run_polling()
+    run_application(application)
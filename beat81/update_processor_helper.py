@@ -0,0 +1,42 @@
+import asyncio
+from collections import Counter
+
+from telegram.ext import BaseUpdateProcessor
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Processes up to max_concurrent_updates updates at once, while the updates of one user
+    still run one after another in the order they arrived. An update waiting for an earlier update
+    of its user doesn't hold one of the concurrent slots."""
+
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        self.user_locks = {}
+        self.pending = Counter()
+
+    async def process_update(self, update, coroutine):
+        user = getattr(update, "effective_user", None)
+        if user is None:
+            await super().process_update(update, coroutine)
+            return
+        lock = self.user_locks.setdefault(user.id, asyncio.Lock())
+        self.pending[user.id] += 1
+        try:
+            # The user's turn first, only then a concurrent slot
+            async with lock:
+                await super().process_update(update, coroutine)
+        finally:
+            # Drop the lock once no update of the user is left, so idle users don't pile up
+            self.pending[user.id] -= 1
+            if not self.pending[user.id]:
+                del self.pending[user.id]
+                del self.user_locks[user.id]
+
+    async def do_process_update(self, update, coroutine):
+        await coroutine
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
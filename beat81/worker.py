@@ -0,0 +1,31 @@
+import asyncio
+import signal
+
+from dotenv import load_dotenv
+
+from beat81.db_helper import close_connection
+from beat81.job_schedule import init_scheduler, shutdown_scheduler
+
+# Load the environment variables from .env file
+load_dotenv()
+
+
+# Runs only the scheduled jobs, without the Telegram bot. Start as many as needed next to the bot,
+# the job leases split the work between them.
+async def run_worker():
+    stopped = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signal_number, stopped.set)
+    init_scheduler()
+    print("Worker started, running the scheduled jobs")
+    try:
+        await stopped.wait()
+    finally:
+        shutdown_scheduler()
+        close_connection()
+        print("Worker stopped")
+
+
+if __name__ == "__main__":
+    asyncio.run(run_worker())
@@ -0,0 +1,5 @@
+import os
+import tempfile
+
+# beat81 opens its database on import, keep it away from the real data directory
+os.environ.setdefault("DATA_DIRECTORY", tempfile.mkdtemp(prefix="beat81-tests-"))
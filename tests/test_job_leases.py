@@ -0,0 +1,143 @@
+import multiprocessing
+import os
+import time
+from datetime import datetime, timezone
+
+import pytest
+
+from beat81 import db_helper, lease_helper, job_schedule
+from beat81.city_helper import City
+
+WORKERS = 4
+USERS = 64
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    db_helper.close_connection()
+    db_helper.user_cache.clear()
+    monkeypatch.setattr(db_helper, "DATABASE_FILE", str(tmp_path / "user_data.db"))
+    db_helper.init_db()
+    yield tmp_path
+    db_helper.close_connection()
+    db_helper.user_cache.clear()
+
+
+@pytest.fixture
+def bookings(tmp_path, monkeypatch):
+    # Every stubbed Beat81 write appends a line, small appends are atomic across processes
+    log_file = tmp_path / "bookings.log"
+
+    def record(*values):
+        with open(log_file, "a") as log:
+            log.write(" ".join(str(value) for value in values) + "\n")
+        time.sleep(0.005)
+        return True
+
+    monkeypatch.setattr(job_schedule, "queue_expired_token_notices", lambda: None)
+    monkeypatch.setattr(job_schedule, "ticket_book", lambda telegram_user_id, ticket_id: record(ticket_id))
+    monkeypatch.setattr(job_schedule, "register_event",
+                        lambda event_id, telegram_user_id: record(event_id, telegram_user_id))
+    monkeypatch.setattr(job_schedule, "event_info",
+                        lambda event_id: {"data": {"max_participants": USERS, "participants_count": 0}})
+
+    def read():
+        if not log_file.exists():
+            return []
+        return log_file.read_text().splitlines()
+
+    return read
+
+
+def save_users():
+    for telegram_user_id in range(1, USERS + 1):
+        db_helper.save_user(telegram_user_id, f"beat81-{telegram_user_id}", f"user{telegram_user_id}@example.com",
+                            "token", "First", "Last")
+
+
+def run_job(job, start_barrier, worker_number):
+    lease_helper.WORKER_ID = f"test-worker-{worker_number}-{os.getpid()}"
+    start_barrier.wait()
+    job()
+
+
+def run_in_processes(job):
+    # The parent's connection must not be shared with the forked workers
+    db_helper.close_connection()
+    context = multiprocessing.get_context("fork")
+    start_barrier = context.Barrier(WORKERS)
+    processes = [context.Process(target=run_job, args=(job, start_barrier, worker_number))
+                 for worker_number in range(WORKERS)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(timeout=60)
+        assert process.exitcode == 0
+
+
+def test_auto_join_job_books_each_ticket_once_across_processes(database, bookings):
+    save_users()
+    for telegram_user_id in range(1, USERS + 1):
+        db_helper.save_auto_join(telegram_user_id, f"ticket-{telegram_user_id}", f"event-{telegram_user_id % 5}")
+
+    run_in_processes(job_schedule.auto_join_job)
+
+    booked = bookings()
+    assert sorted(booked) == sorted(f"ticket-{telegram_user_id}" for telegram_user_id in range(1, USERS + 1))
+    assert db_helper.get_due_auto_joins() == []
+
+
+def test_subscription_job_registers_each_slot_once_across_processes(database, bookings, monkeypatch):
+    save_users()
+    for telegram_user_id in range(1, USERS + 1):
+        db_helper.save_subscription(telegram_user_id, f"location-{telegram_user_id % 3}", City.munich,
+                                    "monday", "18:00")
+
+    # Only the slots that are already bookable are registered by the sweep itself
+    subscription = db_helper.get_active_subscriptions()[0]
+    now = datetime.now(timezone.utc)
+    slot_dates = [date for date in job_schedule.subscription_dates(subscription, now + job_schedule.BOOKING_WINDOW)
+                  if job_schedule.booking_open_time(date) <= now]
+    slot_events = [{"id": f"location-{location}-{date:%Y%m%d}", "location_id": f"location-{location}",
+                    "date_begin": date.strftime("%Y-%m-%dT%H:%M:%S.000Z")}
+                   for location in range(3) for date in slot_dates]
+    monkeypatch.setattr(job_schedule, "day_events", lambda city, day: slot_events)
+    monkeypatch.setattr(job_schedule, "schedule_subscription_slot", lambda subscription, date: None)
+
+    run_in_processes(job_schedule.subscription_job)
+
+    booked = bookings()
+    expected = [f"location-{telegram_user_id % 3}-{date:%Y%m%d} {telegram_user_id}"
+                for telegram_user_id in range(1, USERS + 1) for date in slot_dates]
+    assert slot_dates
+    assert sorted(booked) == sorted(expected)
+
+
+def test_expired_lease_is_taken_over(database):
+    assert db_helper.acquire_lease("job", 0, "worker-a", "run-1", 60, now=1000)
+    assert not db_helper.acquire_lease("job", 0, "worker-b", "run-1", 60, now=1030)
+    assert db_helper.acquire_lease("job", 0, "worker-b", "run-1", 60, now=1061)
+    # The previous owner notices the takeover on its next renewal
+    assert not db_helper.renew_lease("job", 0, "worker-a", 60, now=1062)
+    assert db_helper.renew_lease("job", 0, "worker-b", 60, now=1062)
+    db_helper.complete_lease("job", 0, "worker-b", "run-1")
+    assert not db_helper.acquire_lease("job", 0, "worker-a", "run-1", 60, now=1070)
+    assert db_helper.acquire_lease("job", 0, "worker-a", "run-2", 60, now=1070)
+
+
+def test_auto_join_job_takes_over_the_shard_of_a_dead_worker(database, bookings):
+    save_users()
+    for telegram_user_id in range(1, USERS + 1):
+        db_helper.save_auto_join(telegram_user_id, f"ticket-{telegram_user_id}", f"event-{telegram_user_id % 5}")
+    now = int(time.time())
+    # A crashed worker left shard 0 leased, its lease expired, shard 1 is still held by a live worker
+    db_helper.acquire_lease("auto_join_job", 0, "dead-worker", "", lease_helper.JOB_LEASE_SECONDS,
+                            now=now - lease_helper.JOB_LEASE_SECONDS - 1)
+    db_helper.acquire_lease("auto_join_job", 1, "live-worker", "", lease_helper.JOB_LEASE_SECONDS, now=now)
+
+    job_schedule.auto_join_job()
+
+    booked = set(bookings())
+    for telegram_user_id in range(1, USERS + 1):
+        in_live_shard = lease_helper.shard_of(telegram_user_id) == 1
+        assert (f"ticket-{telegram_user_id}" in booked) != in_live_shard